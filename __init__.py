@@ -1,5 +1,6 @@
 import fileops
 import procops
+import statops
 import visops
 import tools
 import configure
\ No newline at end of file
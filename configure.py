@@ -57,8 +57,15 @@ scriptDir = '/scr/kansas1/surchs/testSurface/scripts'
 
 
 # set this variable to True if you want to work on the level of individual
-# cortical regions as defined by freesurfer label files
+# cortical regions as defined by the parcels of a freesurfer annotation file
 doLabel = True
+# how the regions are scored if doLabel is set:
+# 'average' - compute the vertex-wise map and average it within every parcel
+# 'parcel' - compute the score directly on the verteces of every parcel
+# 'dilated' - like 'parcel', but the parcel grows by the radius
+# 'parcel' and 'dilated' don't need the vertex-wise neighbourhoods and are
+# much faster
+labelMode = 'average'
 
 # full path to temporary working directory
 tempDir = os.path.join(baseDir, 'temp')
@@ -109,12 +116,31 @@ templateName = 'fsaverage5'
 templateSurface = 'inflated'
 
 # score that is used for the surface computation. There are a number of scores
-# available, refer to the readme file for a list
+# available, refer to the readme file for a list (or run python procops.py)
 score = 'zspear'
+# name template for the covariate, only used by scores that control for one
+# (like 'partialr')
+covariateTemp = 'curv_%s_%s2fsaverage5_6'
+
+# null model for empirical p-values of the maps. The p-values are written next
+# to the maps with a _pval suffix (per parcel if doLabel is set)
+# None - no p-values
+# 'spin' - rotations of the overlay on the sphere, keeps its autocorrelation
+# 'shuffle' - random permutations of the overlay between verteces
+nullModel = None
+numberPermutations = 1000
+# number of surrogate maps that are scored at once, this bounds the memory
+permutationChunk = 100
+# seed of the surrogates, all subjects are tested against the same ones
+nullSeed = 0
 
 # Set this to true if you want to use the absolute values of the overlay
 useAbsVals = True
 
+# number of subjects that are scored together. Larger batches share the
+# neighbourhood lookups between more subjects but need more memory
+subjectBatchSize = 16
+
 # name template for the output of the surface computation
 # the placeholders get filled out like this (subject nami, radius, hemisphere)
 correlationOutName = '%s_correlation_%d_%s'
@@ -127,6 +153,17 @@ correlationInputDir = gradientOutPutDir
 # full path to the output directory where the surface processing will be saved
 # in subdirectories for each subject
 correlationOutDir = os.path.join(baseDir, 'corrOut')
+# full path to the manifest that records the inputs, parameters and outputs of
+# every subject, hemisphere and radius. Reruns skip the ones that are up to
+# date. Set to None to always recompute everything
+manifestPath = os.path.join(correlationOutDir, 'manifest.json')
+# full path to the cohort store: one file per hemisphere and output with the
+# maps of all subjects and radii, which the group analyses read directly. Set
+# to None to write the maps of every subject as mgh files instead
+cohortDir = os.path.join(correlationOutDir, 'cohort')
+# set this to True to also write the maps of every subject as mgh files when
+# there is a cohort store ('python wrapper.py export' does it afterwards)
+exportSubjectMaps = False
 
 # do not change this, this is part of a fixed template
 templateTemp = '%%s.%s' % (templateSurface)
@@ -140,6 +177,35 @@ maskTemp = os.path.join(templateDir, templateName, 'label', '%s.cortex.label')
 
 # set the path to the label file
 labelPath = os.path.join(labelDir, 'labelFile.txt')
+# annotation of the template that defines the parcels for the label
+# processing, the placeholder is the hemisphere
+annotTemp = os.path.join(templateDir, templateName, 'label', '%s.aparc.annot')
+# sphere of the template, only used by the spin null model
+sphereTemp = os.path.join(templateDir, templateName, 'surf', '%s.sphere')
+
+# method used to compute the geodesic distances for the sliding window:
+# 'graph' - shortest paths along the triangle edges (overestimates distances)
+# 'heat' - the heat method on the triangles
+# 'exact' - exact geodesics on the triangles (needs the gdist package)
+geodesicMethod = 'graph'
+# number of processes that compute the neighbourhoods in parallel. Set this
+# to the number of cores that are available to one job
+neighbourWorkers = 1
+# number of verteces whose neighbourhoods are computed at once. Every block
+# holds a dense (#block, #verteces) array of distances, so lower this for
+# large templates
+neighbourBlockSize = 256
+
+# full path to the directory where the neighbourhoods of the template are
+# cached between runs and jobs. Set to None to always recompute them
+neighbourCacheDir = os.path.join(baseDir, 'neighbourCache')
+# maximum size of the neighbourhood cache in bytes, the least recently used
+# entries are removed beyond that
+neighbourCacheSize = 10 * 1024 ** 3
+# most bytes of loaded surfaces, masks and maps that are kept in memory, so
+# files that are loaded again (e.g. the template for every stage) are not read
+# from disk again. Set to 0 to switch this off
+loaderCacheSize = 1024 ** 3
 
 #===============================================================================
 # GLM Configuration
@@ -151,11 +217,33 @@ glmContrastName = 'contrast_node_gradsulc_%d_%s'
 glmDesigMatName = 'fsgd_node_gradsulc_%d_%s.fsgd'
 glmScriptName = 'script_node_gradsulc_%d_%s'
 
-# parameters for cluster level correction of the glm results
-vertexThresh = '0.99'
-clustThresh = '0.05'
+# number of threads that read the subject maps when they are stacked for the
+# glm and the group analyses
+stackThreads = 4
+
+# parameters for cluster level correction of the glm results: the cluster
+# forming threshold as -log10(p), the cluster-wise p threshold and the signs
+# that are tested ('pos', 'neg' or 'both')
+vertexThresh = 0.99
+clustThresh = 0.05
 posneg = 'both'
 
+# parameters of the group test that runs without mri_glmfit (wrapper.py group):
+# the number of sign flip permutations, how many of them are done at once and
+# the seed of the sign flips
+groupPermutations = 5000
+groupChunk = 100
+groupSeed = 0
+
+# design of the glm that runs without mri_glmfit (wrapper.py fitglm). Set
+# glmFsgdPath to an FSGD file with classes and continuous variables, otherwise
+# all subjects are one group. The model type is 'dods' or 'doss'
+glmFsgdPath = None
+glmModelType = 'dods'
+# contrast matrix files, one row per contrast and one column per regressor.
+# Without contrasts the first regressor (the mean of the first class) is tested
+glmContrastPaths = []
+
 # name for the glm condor file
 glmCondorName = 'runall_fsaverage5_node_correlation'
 
@@ -164,14 +252,24 @@ glmPrepDir = os.path.join('glmPrep')
 # full path to the directory where the glm outputs will be saved
 glmOutDir = os.path.join('glmOut')
 
+# summary of the label outputs across subjects (wrapper.py labelstats): the
+# confidence level, the number of bootstrap resamples, how many of them are
+# done at once and their seed. The table is written to labelSummaryPath (.txt)
+bootstrapConfidence = 0.95
+bootstrapResamples = 10000
+bootstrapChunk = 1000
+bootstrapSeed = 0
+labelSummaryPath = os.path.join(glmOutDir, 'labelSummary')
+
 #===============================================================================
 # Call the path checkin function
 #===============================================================================
-inputs = [scriptDir, templateDir, pathToGradientScript, pathToLabelScript,
-          subjectListFile]
+inputs = [scriptDir, templateDir, pathToGradientScript, subjectListFile]
 
 outputs = [condorDir, glmPrepDir, glmOutDir, correlationOutDir,
                gradientOutPutDir, labelDir, logDir, tempDir]
+if neighbourCacheDir:
+    outputs.append(neighbourCacheDir)
 
 makePaths(inputs, outputs)
 
@@ -11,49 +11,230 @@ stuff I want to have here:
 - conversion of files into standard data formats (if this will be necessary)
 '''
 import os
+import gzip
+import json
+import shutil
+import hashlib
+import struct
+import functools
+import threading
+import collections
+import tempfile
 import subprocess
 import numpy as np
+import nibabel as nib
+from multiprocessing.pool import ThreadPool
 from surfer import io
 import surfaceProcessing as sp
 from nibabel import freesurfer as nfs
 
 
+#===============================================================================
+#------------------------------------------------------------------ Loader Cache
+#===============================================================================
+# files that were loaded by the cached loaders, least recently used first.
+# The keys are the loader, the (path, modification time, size) of the file and
+# the other arguments, so a file that changes is loaded again
+_loaderCache = collections.OrderedDict()
+_loaderCacheState = {'maxBytes': 1024 ** 3,
+                     'bytes': 0,
+                     'hits': 0,
+                     'misses': 0}
+_loaderCacheLock = threading.Lock()
+
+
+def cachedNbytes(value):
+    '''
+    Returns the number of bytes of the arrays in a loaded value
+    '''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum([cachedNbytes(element) for element in value])
+
+    return 0
+
+
+def freezeLoaded(value):
+    '''
+    Makes the arrays in a loaded value read only, so the cached value can be
+    handed to every caller
+    '''
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, (tuple, list)):
+        for element in value:
+            freezeLoaded(element)
+
+    return value
+
+
+def evictLoaderCache(maxBytes):
+    '''
+    Removes the least recently used files until the cache holds no more than
+    maxBytes. Call this with the lock held
+    '''
+    while _loaderCache and _loaderCacheState['bytes'] > maxBytes:
+        key, (value, size) = _loaderCache.popitem(last=False)
+        _loaderCacheState['bytes'] -= size
+
+
+def setLoaderCacheSize(maxBytes):
+    '''
+    Sets the most bytes of loaded arrays that are kept in the cache. Set it
+    to 0 to switch the cache off
+    '''
+    _loaderCacheLock.acquire()
+    try:
+        _loaderCacheState['maxBytes'] = maxBytes
+        evictLoaderCache(maxBytes)
+    finally:
+        _loaderCacheLock.release()
+
+
+def clearLoaderCache():
+    '''
+    Removes all files from the cache and resets the statistics
+    '''
+    _loaderCacheLock.acquire()
+    try:
+        _loaderCache.clear()
+        _loaderCacheState['bytes'] = 0
+        _loaderCacheState['hits'] = 0
+        _loaderCacheState['misses'] = 0
+    finally:
+        _loaderCacheLock.release()
+
+
+def loaderCacheStats():
+    '''
+    Returns the hits, misses, number of files and bytes of the cache and its
+    byte limit as a dictionary
+    '''
+    _loaderCacheLock.acquire()
+    try:
+        stats = dict(_loaderCacheState)
+        stats['files'] = len(_loaderCache)
+    finally:
+        _loaderCacheLock.release()
+
+    return stats
+
+
+def cachedLoader(loader):
+    '''
+    Wraps a loader that takes the path of a file as first argument, so files
+    that did not change since they were last loaded come from the cache. The
+    arrays of the loaded value are read only. The loader without the cache
+    is kept as the uncached attribute, e.g. for files that are only read
+    once
+    '''
+    @functools.wraps(loader)
+    def cachedLoad(path, *args, **kwargs):
+        if _loaderCacheState['maxBytes'] <= 0 or not os.path.isfile(path):
+            return loader(path, *args, **kwargs)
+        status = os.stat(path)
+        key = (loader.__name__, os.path.abspath(path), status.st_mtime,
+               status.st_size, args, tuple(sorted(kwargs.items())))
+        _loaderCacheLock.acquire()
+        try:
+            if key in _loaderCache:
+                entry = _loaderCache.pop(key)
+                _loaderCache[key] = entry
+                _loaderCacheState['hits'] += 1
+                return entry[0]
+            _loaderCacheState['misses'] += 1
+        finally:
+            _loaderCacheLock.release()
+
+        value = freezeLoaded(loader(path, *args, **kwargs))
+        size = cachedNbytes(value)
+        _loaderCacheLock.acquire()
+        try:
+            maxBytes = _loaderCacheState['maxBytes']
+            # older versions of the file are not needed any more
+            for oldKey in [oldKey for oldKey in _loaderCache
+                           if oldKey[:2] == key[:2]
+                           and oldKey[2:4] != key[2:4]]:
+                _loaderCacheState['bytes'] -= _loaderCache.pop(oldKey)[1]
+            if size <= maxBytes and not key in _loaderCache:
+                _loaderCache[key] = (value, size)
+                _loaderCacheState['bytes'] += size
+                evictLoaderCache(maxBytes)
+        finally:
+            _loaderCacheLock.release()
+
+        return value
+
+    cachedLoad.uncached = loader
+
+    return cachedLoad
+
+
 #===============================================================================
 #----------------------------------------------------------------- Loading Files
 #===============================================================================
+@cachedLoader
 def loadScalar(pathToScalar):
     '''
-    Method to read scalar vectors for example in mgh format
+    Method to read scalar vectors for example in mgh format. mgh files are
+    read directly (and memory mapped), gifti and 1D files are parsed natively,
+    everything else goes through pysurfer
     '''
-    outVec = io.read_scalar_data(pathToScalar)
+    if pathToScalar.endswith('.mgh') or pathToScalar.endswith('.mgz'):
+        outVec = loadMgh(pathToScalar)
+    elif pathToScalar.endswith('.gii'):
+        outVec = loadGiftiMorphometry(pathToScalar)
+    elif pathToScalar.endswith('.1D'):
+        lines, outVec = loadColumn(pathToScalar)
+    else:
+        outVec = io.read_scalar_data(pathToScalar)
 
     return outVec
 
 
-def loadVector(pathToVector, drop=0):
+def loadColumn(pathToText, drop=0):
     '''
-    Loads a vector like a text file and returns a numpy array
+    Reads the first column of a text file (AFNI 1D, FreeSurfer label or ascii
+    files) in one go with numpy after dropping the first lines. Lines starting
+    with # are comments. If some lines do not start with a number (headers in
+    the middle of the file), only the numeric lines are kept. Returns the
+    lines and the column
     '''
-    valList = []
-    f = open(pathToVector, 'rb')
+    f = open(pathToText, 'rb')
     for i in xrange(drop):
-        tempVal = f.readline()
-    values = f.readlines()
+        f.readline()
+    lines = f.readlines()
     f.close()
 
-    for value in values:
-        valList.append(float(value.strip().split(' ')[0]))
+    try:
+        column = np.loadtxt(lines, usecols=(0,), comments='#', ndmin=1)
+    except ValueError:
+        firstValues = [line.split()[0] for line in lines if line.split()]
+        column = np.array([float(value) for value in firstValues
+                           if sp.tools.isNumber(value)])
+
+    return lines, column
 
-    outVec = np.array(valList)
+
+@cachedLoader
+def loadVector(pathToVector, drop=0):
+    '''
+    Loads a vector like a text file and returns a numpy array
+    '''
+    lines, outVec = loadColumn(pathToVector, drop=drop)
 
     return outVec
 
 
+@cachedLoader
 def loadSurface(pathToSurface):
     '''
-    This method loads the surface from a mgh file and returns it. Pretty simple
-    stuff
+    This method loads the surface from a freesurfer or gifti file and returns
+    it. Pretty simple stuff
     '''
+    if pathToSurface.endswith('.gii'):
+        return loadGiftiSurface(pathToSurface)
     print('Loading %s' % (pathToSurface))
     surface = nfs.read_geometry(pathToSurface)
 
@@ -64,17 +245,7 @@ def loadLabel(pathToLabel, drop=2):
     '''
     load the label text file
     '''
-    f = open(pathToLabel, 'rb')
-    for i in xrange(drop):
-        f.readline()
-    lines = f.readlines()
-    f.close()
-
-    verteces = []
-    for line in lines:
-        useLine = line.strip().split()
-        if sp.tools.isNumber(useLine[0]):
-            verteces.append(float(useLine[0]))
+    lines, verteces = loadColumn(pathToLabel, drop=drop)
 
     return lines, verteces
 
@@ -91,6 +262,20 @@ def loadAnnotation(pathToAnnotation):
     return annot
 
 
+def loadParcels(pathToAnnotation):
+    '''
+    Loads an annotation file as an integer vector with the parcel of every
+    vertex and the list of parcel names. Verteces that are not in any parcel
+    get -1
+    '''
+    parcelIds, colorTable, names = loadAnnotation(pathToAnnotation)
+    parcelIds = np.asarray(parcelIds, dtype=int)
+    names = [str(name.decode()) if isinstance(name, bytes) else str(name)
+             for name in names]
+
+    return parcelIds, names
+
+
 def loadMorphometry(pathToMorphometry):
     '''
     This loads a morphometry file, like thickness
@@ -101,25 +286,217 @@ def loadMorphometry(pathToMorphometry):
     return morphometry
 
 
+def loadGifti(pathToGifti):
+    '''
+    Loads a gifti file with nibabel. This reads binary, base64 (also gzipped)
+    and ascii encoded gifti files directly, so neither gifti_tool nor
+    wb_command are needed to make them readable
+    '''
+    print('Loading %s' % (pathToGifti))
+    gifti = nib.load(pathToGifti)
+
+    return gifti
+
+
+def giftiArrays(gifti, intent):
+    '''
+    Returns the data arrays of a gifti image that have the given nifti intent
+    (e.g. NIFTI_INTENT_POINTSET)
+    '''
+    intentCode = nib.nifti1.intent_codes.code[intent]
+    arrays = [darray.data for darray in gifti.darrays
+              if darray.intent == intentCode]
+
+    return arrays
+
+
+def loadGiftiSurface(pathToSurface):
+    '''
+    Loads a gifti surface and returns it in the same format as a freesurfer
+    surface:
+    [0]    - coordinates of the verteces (#verteces by 3)
+    [1]    - faces (#faces by 3)
+    '''
+    gifti = loadGifti(pathToSurface)
+    coords = giftiArrays(gifti, 'NIFTI_INTENT_POINTSET')
+    faces = giftiArrays(gifti, 'NIFTI_INTENT_TRIANGLE')
+    if not coords or not faces:
+        message = ('%s does not contain coordinates and faces. Is this '
+                   'really a surface?' % (pathToSurface))
+        raise Exception(message)
+    surface = (np.asarray(coords[0], dtype=float),
+               np.asarray(faces[0], dtype=int))
+
+    return surface
+
+
 def loadGiftiMorphometry(pathToMorphometry):
     '''
-    This loads a gifti morphometry file and turns it into something readable
+    Loads a gifti metric (func.gii or shape.gii) file. All data arrays that are
+    not coordinates or faces are stacked, so a single map comes back as a
+    vector and multiple maps as a #maps by #verteces matrix
     '''
-    f = open(pathToMorphometry, 'rb')
-    lines = f.readlines()
+    gifti = loadGifti(pathToMorphometry)
+    geometry = [nib.nifti1.intent_codes.code['NIFTI_INTENT_POINTSET'],
+                nib.nifti1.intent_codes.code['NIFTI_INTENT_TRIANGLE']]
+    arrays = [np.asarray(darray.data).ravel() for darray in gifti.darrays
+              if darray.intent not in geometry]
+    if not arrays:
+        message = ('%s does not contain any data arrays' % (pathToMorphometry))
+        raise Exception(message)
+    if len(arrays) == 1:
+        outVector = arrays[0]
+    else:
+        outVector = np.vstack(arrays)
+
+    return outVector
+
+
+#===============================================================================
+#--------------------------------------------------------------------- MGH Files
+#===============================================================================
+# Layout of the freesurfer mgh format: a big-endian header of 7 ints (version,
+# width, height, depth, frames, type, dof), the goodRASflag (short) and the
+# geometry (15 floats), padded to 284 bytes. The data follows with the width
+# running fastest, then 5 floats of scan parameters (TR, flip angle, TE, TI,
+# FoV). Surface maps have one column per vertex in the width.
+mghHeaderSize = 284
+mghTypes = {0: np.dtype('>u1'),
+            1: np.dtype('>i4'),
+            3: np.dtype('>f4'),
+            4: np.dtype('>i2')}
+
+
+def readMghHeader(pathToMgh):
+    '''
+    Reads the header of an mgh or mgz file. Returns a dictionary with the
+    'shape' of the data as (frames, depth, height, width), its 'dtype' and
+    the 'goodRAS' flag
+    '''
+    if pathToMgh.endswith('.mgz'):
+        f = gzip.open(pathToMgh, 'rb')
+    else:
+        f = open(pathToMgh, 'rb')
+    headerBytes = f.read(mghHeaderSize)
     f.close()
+    if len(headerBytes) < mghHeaderSize:
+        message = ('%s is too short to be an mgh file' % (pathToMgh))
+        raise Exception(message)
 
-    valueList = []
+    values = struct.unpack('>7ih', headerBytes[:30])
+    version, width, height, depth, frames, dataType, dof, goodRAS = values
+    if version != 1 or not dataType in mghTypes:
+        message = ('%s is not an mgh file I can read (version %d, type %d)'
+                   % (pathToMgh, version, dataType))
+        raise Exception(message)
+    header = {'shape': (frames, depth, height, width),
+              'dtype': mghTypes[dataType],
+              'goodRAS': goodRAS}
 
-    for line in lines:
-        useLine = line.strip().split()
-        # check if only one element and if element is number
-        if sp.tools.isNumber(useLine[0]):
-            valueList.append(float(useLine[0]))
+    return header
 
-    outVector = np.array(valueList)
 
-    return outVector
+def loadMgh(pathToMgh, mmap=True):
+    '''
+    Loads the data of an mgh or mgz file. Uncompressed mgh files are memory
+    mapped (read only) unless mmap is False, so only the parts that are used
+    are read from disk. Surface maps come back as a (#verteces,) vector, or
+    as (#frames, #verteces) if they have more than one frame. Volumes keep
+    the (frames, depth, height, width) shape
+    '''
+    header = readMghHeader(pathToMgh)
+    shape = header['shape']
+    dtype = header['dtype']
+    if pathToMgh.endswith('.mgz'):
+        f = gzip.open(pathToMgh, 'rb')
+        f.read(mghHeaderSize)
+        numberBytes = int(np.prod(shape)) * dtype.itemsize
+        data = np.frombuffer(f.read(numberBytes), dtype=dtype)
+        f.close()
+        data = data.reshape(shape)
+    elif mmap:
+        data = np.memmap(pathToMgh, dtype=dtype, mode='r',
+                         offset=mghHeaderSize, shape=shape)
+    else:
+        f = open(pathToMgh, 'rb')
+        f.seek(mghHeaderSize)
+        data = np.fromfile(f, dtype=dtype, count=int(np.prod(shape)))
+        f.close()
+        data = data.reshape(shape)
+
+    frames, depth, height, width = shape
+    if depth == 1 and height == 1:
+        data = data.reshape(frames, width)
+        if frames == 1:
+            data = data[0]
+
+    return data
+
+
+def mghHeader(width, frames):
+    '''
+    Returns the header bytes freesurfer writes for float surface maps: one
+    column per vertex and the default geometry with 1mm voxels
+    '''
+    header = struct.pack('>7ih', 1, width, 1, 1, frames, 3, 0, 1)
+    # voxel sizes, direction cosines (LIA) and center
+    geometry = struct.pack('>15f', 1, 1, 1,
+                           -1, 0, 0,
+                           0, 0, -1,
+                           0, 1, 0,
+                           0, 0, 0)
+    padding = b'\0' * (mghHeaderSize - len(header) - len(geometry))
+
+    return b''.join([header, geometry, padding])
+
+
+def saveMgh(outPath, data):
+    '''
+    Writes a surface map (#verteces,) or a stack of them (#frames,
+    #verteces) as a float mgh file in one write. The header is the one
+    freesurfer writes for surface maps: one column per vertex and the
+    default geometry with 1mm voxels
+    '''
+    data = np.asarray(data, dtype='>f4')
+    if data.ndim == 1:
+        data = data[np.newaxis, :]
+    frames, width = data.shape
+
+    scanParameters = struct.pack('>5f', 0, 0, 0, 0, 0)
+    outBytes = b''.join([mghHeader(width, frames), data.tobytes(),
+                         scanParameters])
+
+    outDir = os.path.dirname(outPath)
+    if outDir and not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    f = open(outPath, 'wb')
+    f.write(outBytes)
+    f.close()
+
+    return outPath
+
+
+def createMgh(outPath, numberVerteces, numberFrames):
+    '''
+    Creates an empty float mgh file with #frames maps of #verteces and returns
+    it as a writable memory map of shape (#frames, #verteces). Every frame is
+    one contiguous block on disk, so frames can be filled one by one without
+    ever holding the whole file in memory
+    '''
+    outDir = os.path.dirname(outPath)
+    if outDir and not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    dataBytes = numberVerteces * numberFrames * 4
+    f = open(outPath, 'wb')
+    f.write(mghHeader(numberVerteces, numberFrames))
+    # the data is left as a hole that the memory map fills in
+    f.seek(mghHeaderSize + dataBytes)
+    f.write(struct.pack('>5f', 0, 0, 0, 0, 0))
+    f.close()
+    stack = np.memmap(outPath, dtype='>f4', mode='r+', offset=mghHeaderSize,
+                      shape=(numberFrames, numberVerteces))
+
+    return stack
 
 
 #===============================================================================
@@ -323,27 +700,87 @@ def mapToSurface(sourceSub, sourceSurf, targetSub, hemi, outPath):
     return output, outPath
 
 
-def stackFiles(listOfPaths, outPath):
+def fillStack(listOfPaths, stack, numberThreads=4):
     '''
-    Method that stacks a list of paths and turns it into an mgh stack
+    Reads the maps in listOfPaths into the rows of stack (#maps, #verteces),
+    which can be an array or a memory map. The files are read by a pool of
+    numberThreads threads, so at most that many files are open and in flight
+    at any time and every map goes straight into its own row
     '''
-    command = ['mri_concat']
+    def readInto(job):
+        row, path = job
+        values = loadScalar.uncached(path)
+        if values.shape != stack.shape[1:]:
+            message = ('%s has %s values but the stack expects %s'
+                       % (path, str(values.shape), str(stack.shape[1:])))
+            raise Exception(message)
+        stack[row] = values
 
-    for path in listOfPaths:
-        # print(pathToSurface)
-        command.append(path)
+        return row
 
-    # Add the output to it
-    command.append("--o")
-    command.append(outPath)
+    pool = ThreadPool(max(1, min(numberThreads, len(listOfPaths))))
+    try:
+        for row in pool.imap_unordered(readInto, enumerate(listOfPaths)):
+            pass
+    finally:
+        pool.close()
+        pool.join()
 
-    print command
-    process = subprocess.Popen(command)
-    output = process.communicate()[0]
+    return stack
+
+
+def loadStack(listOfPaths, numberThreads=4):
+    '''
+    Loads a list of surface maps into one (#maps, #verteces) float matrix.
+    The size comes from the header of the first map, the matrix is allocated
+    once and filled by fillStack
+    '''
+    numberVerteces = loadScalar.uncached(listOfPaths[0]).shape[0]
+    stack = np.empty((len(listOfPaths), numberVerteces), dtype=float)
+    stack = fillStack(listOfPaths, stack, numberThreads=numberThreads)
+
+    return stack
+
+
+def stackFiles(listOfPaths, outPath, numberThreads=4):
+    '''
+    Method that stacks a list of paths and turns it into an mgh stack with
+    one frame per path (what mri_concat does). The stack is created as an
+    empty memory mapped mgh file and the maps are streamed into their frames
+    by fillStack, so neither the command line nor the memory limit the
+    number of maps
+    '''
+    if not listOfPaths:
+        message = ('There are no files to stack into %s' % (outPath))
+        raise Exception(message)
+    numberVerteces = loadScalar.uncached(listOfPaths[0]).shape[0]
+    print('Stacking %d maps into %s' % (len(listOfPaths), outPath))
+    stack = createMgh(outPath, numberVerteces, len(listOfPaths))
+    fillStack(listOfPaths, stack, numberThreads=numberThreads)
+    stack.flush()
+    del stack
 
     return outPath
 
 
+def linkFile(sourcePath, targetPath):
+    '''
+    Makes sourcePath available at targetPath without copying it: as a hard
+    link where possible, otherwise (e.g. across file systems) as a symbolic
+    link. If targetPath is a directory, the link gets the name of the source
+    '''
+    if os.path.isdir(targetPath):
+        targetPath = os.path.join(targetPath, os.path.basename(sourcePath))
+    if os.path.lexists(targetPath):
+        os.remove(targetPath)
+    try:
+        os.link(sourcePath, targetPath)
+    except OSError:
+        os.symlink(os.path.abspath(sourcePath), targetPath)
+
+    return targetPath
+
+
 def runSubprocess(command):
     # Just runs the subprocess
     # print(('Running command:\n%s' % (str(command)))
@@ -381,14 +818,15 @@ def writeVector(surface, vector, mode='oneD'):
                   + '#  Parent_side = "R"\n'
                   + '#  Label = "0"\n'
                   + '# >')
-        # Loop through the verteces and write
+        # Collect the lines of all verteces and join them once
+        lines = [outStr]
         for vertex, score in enumerate(vector):
-            # outStr = ('%s\n%s %s' % (outStr, str(vertex).zfill(3), score))
-            outStr = ('%s\n%s' % (outStr, score))
+            lines.append(str(score))
+        outStr = '\n'.join(lines)
 
     elif mode == 'ascii':
         # write to freesurfer's ascii format
-        outStr = ''
+        lines = []
         # loop through the verteces and write
         for vertex, score in enumerate(vector):
             location = surface[0][vertex]
@@ -397,7 +835,8 @@ def writeVector(surface, vector, mode='oneD'):
                                                str(location[1]),
                                                str(location[2]),
                                                str(score)))
-            outStr = (outStr + '%s\n' % (writeStr))
+            lines.append('%s\n' % (writeStr))
+        outStr = ''.join(lines)
     else:
         # something went wrong
         message = ('The specified format (%s) is not implemented.'
@@ -485,6 +924,75 @@ def genFsgdFile(subjectList, outPath):
     return outPath
 
 
+def loadFsgd(fsgdPath):
+    '''
+    Reads a freesurfer group descriptor (FSGD) file. Returns a dictionary
+    with
+        - 'title': the title of the file
+        - 'classes': the names of the classes in the order they are declared
+        - 'variables': the names of the continuous variables
+        - 'subjects': the subject IDs in the order of the Input lines
+        - 'subjectClasses': the class of every subject
+        - 'values': a (#subjects, #variables) array of the variables
+        - 'demean': whether the variables are demeaned (DeMeanFlag, on if
+          the file doesn't say)
+    '''
+    fsgd = {'title': '',
+            'demean': True,
+            'classes': [],
+            'variables': [],
+            'subjects': [],
+            'subjectClasses': [],
+            'values': []}
+    f = open(fsgdPath, 'r')
+    fsgdLines = f.readlines()
+    f.close()
+
+    for line in fsgdLines:
+        useLine = line.strip().split()
+        if not useLine or useLine[0].startswith('#'):
+            continue
+        keyword = useLine[0].lower()
+        if keyword == 'title':
+            fsgd['title'] = ' '.join(useLine[1:])
+        elif keyword == 'class':
+            fsgd['classes'].append(useLine[1])
+        elif keyword == 'variables':
+            fsgd['variables'] = useLine[1:]
+        elif keyword == 'demeanflag':
+            fsgd['demean'] = int(useLine[1]) != 0
+        elif keyword == 'input':
+            subject, subjectClass = useLine[1:3]
+            values = [float(value) for value in useLine[3:]]
+            if len(values) != len(fsgd['variables']):
+                message = ('Subject %s has %d variables in %s, expected %d'
+                           % (subject, len(values), fsgdPath,
+                              len(fsgd['variables'])))
+                raise Exception(message)
+            # classes don't have to be declared before they are used
+            if not subjectClass in fsgd['classes']:
+                fsgd['classes'].append(subjectClass)
+            fsgd['subjects'].append(subject)
+            fsgd['subjectClasses'].append(subjectClass)
+            fsgd['values'].append(values)
+
+    numberVariables = len(fsgd['variables'])
+    fsgd['values'] = np.array(fsgd['values'],
+                              dtype=float).reshape(-1, numberVariables)
+
+    return fsgd
+
+
+def loadContrast(contrastPath):
+    '''
+    Reads a contrast matrix file (one row per contrast, one column per
+    regressor of the design) as a 2D array
+    '''
+    contrast = np.atleast_2d(np.loadtxt(contrastPath, ndmin=2))
+
+    return contrast
+
+
 def genGlm(doFTest, contrastPaths, fsgdPath, hemisphere, concatPath,
                 modelPath, modelType,
                 vertexThresh, clustThresh, posneg):
@@ -577,5 +1085,469 @@ def findFileAtPath(fileName, searchPath):
         return None
 
 
+#===============================================================================
+#----------------------------------------------------------- Neighbourhood Cache
+#===============================================================================
+# bump this whenever the layout of the cached neighbourhoods changes
+# 2: neighbours are sorted by distance
+neighbourCacheVersion = 2
+
+
+def neighbourCacheKey(surface, mask, radius, weighted=True, method='graph'):
+    '''
+    Generates the content hash that identifies a set of neighbourhoods. The
+    key changes whenever the vertex coordinates, the triangles, the mask,
+    the radius or the geodesic method change.
+    '''
+    hasher = hashlib.sha1()
+    hasher.update(('v%d ' % (neighbourCacheVersion)).encode('ascii'))
+    hasher.update(templateCacheKey(surface).encode('ascii'))
+    maskArray = np.unique(np.asarray(mask, dtype=np.int64))
+    hasher.update(maskArray.tobytes())
+    hasher.update(('%r %r %s' % (float(radius), bool(weighted), method))
+                  .encode('ascii'))
+
+    return hasher.hexdigest()
+
+
+def templateCacheKey(surface):
+    '''
+    Generates the content hash of the template surface alone
+    '''
+    hasher = hashlib.sha1()
+    for array in (surface[0], surface[1]):
+        array = np.ascontiguousarray(array)
+        hasher.update(('%s %s' % (array.dtype.str, str(array.shape)))
+                      .encode('ascii'))
+        hasher.update(array.tobytes())
+
+    return hasher.hexdigest()
+
+
+def saveNeighbourIndex(outDir, neighbourIndex, meta=None):
+    '''
+    Writes the arrays of a NeighbourIndex as .npy files into outDir so that
+    they can be memory-mapped later on
+    '''
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    np.save(os.path.join(outDir, 'indptr.npy'), neighbourIndex.indptr)
+    np.save(os.path.join(outDir, 'indices.npy'), neighbourIndex.indices)
+    np.save(os.path.join(outDir, 'distances.npy'), neighbourIndex.distances)
+
+    if meta is None:
+        meta = {}
+    meta['radius'] = neighbourIndex.radius
+    f = open(os.path.join(outDir, 'meta.json'), 'w')
+    json.dump(meta, f)
+    f.close()
+
+    return outDir
+
+
+def loadNeighbourIndex(inDir, mmap=True):
+    '''
+    Loads a NeighbourIndex that was written with saveNeighbourIndex. By
+    default, the arrays are memory-mapped read-only instead of copied
+    '''
+    mmapMode = 'r' if mmap else None
+    indptr = np.load(os.path.join(inDir, 'indptr.npy'), mmap_mode=mmapMode)
+    indices = np.load(os.path.join(inDir, 'indices.npy'), mmap_mode=mmapMode)
+    distances = np.load(os.path.join(inDir, 'distances.npy'),
+                        mmap_mode=mmapMode)
+    meta = loadCacheMeta(inDir)
+    neighbourIndex = sp.procops.NeighbourIndex(indptr, indices, distances,
+                                               meta['radius'])
+
+    return neighbourIndex
+
+
+def loadCacheMeta(entryDir):
+    '''
+    Reads the meta data of a cache entry
+    '''
+    f = open(os.path.join(entryDir, 'meta.json'), 'r')
+    meta = json.load(f)
+    f.close()
+
+    return meta
+
+
+def loadCachedNeighbours(cacheDir, key):
+    '''
+    Opens the cached neighbourhoods stored under key. Returns None if there is
+    no such entry in the cache
+    '''
+    entryDir = os.path.join(cacheDir, key)
+    if not os.path.isfile(os.path.join(entryDir, 'meta.json')):
+        return None
+    print('Loading cached neighbourhoods from %s' % (entryDir))
+    neighbourIndex = loadNeighbourIndex(entryDir)
+    # mark the entry as recently used for the eviction
+    os.utime(os.path.join(entryDir, 'meta.json'), None)
+
+    return neighbourIndex
+
+
+def storeCachedNeighbours(cacheDir, key, neighbourIndex, meta=None):
+    '''
+    Stores neighbourhoods in the cache under key. The entry is written to a
+    temporary directory first and then moved into place, so concurrent jobs
+    never see half-written entries
+    '''
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    entryDir = os.path.join(cacheDir, key)
+    tempDir = tempfile.mkdtemp(prefix='.%s_' % (key), dir=cacheDir)
+    saveNeighbourIndex(tempDir, neighbourIndex, meta=meta)
+    try:
+        os.rename(tempDir, entryDir)
+    except OSError:
+        # somebody else stored the same entry in the meantime
+        shutil.rmtree(tempDir, ignore_errors=True)
+    print('Stored neighbourhoods in %s' % (entryDir))
+
+    return entryDir
+
+
+def listNeighbourCache(cacheDir):
+    '''
+    Returns a list of (lastUsed, size, entryDir) tuples for all complete
+    entries in the cache, oldest first
+    '''
+    entries = []
+    if not os.path.isdir(cacheDir):
+        return entries
+    for key in os.listdir(cacheDir):
+        entryDir = os.path.join(cacheDir, key)
+        metaPath = os.path.join(entryDir, 'meta.json')
+        if key.startswith('.') or not os.path.isfile(metaPath):
+            continue
+        size = 0
+        for fileName in os.listdir(entryDir):
+            size += os.path.getsize(os.path.join(entryDir, fileName))
+        entries.append((os.path.getmtime(metaPath), size, entryDir))
+    entries.sort()
+
+    return entries
+
+
+def evictNeighbourCache(cacheDir, maxSize):
+    '''
+    Removes the least recently used entries until the cache is no larger than
+    maxSize bytes. Returns the list of removed entries
+    '''
+    entries = listNeighbourCache(cacheDir)
+    totalSize = sum([entry[1] for entry in entries])
+    removed = []
+    for lastUsed, size, entryDir in entries:
+        if totalSize <= maxSize:
+            break
+        print('Evicting %s from the neighbourhood cache' % (entryDir))
+        shutil.rmtree(entryDir, ignore_errors=True)
+        totalSize -= size
+        removed.append(entryDir)
+
+    return removed
+
+
+def invalidateNeighbourCache(cacheDir, templatePath=None, templateKey=None):
+    '''
+    Removes cache entries. Without arguments the whole cache is cleared. If
+    templatePath is given, only the entries computed for this template path
+    are removed - except for those matching templateKey, i.e. the ones that
+    were computed for the current version of the template
+    '''
+    removed = []
+    for lastUsed, size, entryDir in listNeighbourCache(cacheDir):
+        meta = loadCacheMeta(entryDir)
+        if templatePath is not None:
+            if meta.get('templatePath') != templatePath:
+                continue
+            if (templateKey is not None
+                    and meta.get('templateKey') == templateKey):
+                continue
+        print('Invalidating %s' % (entryDir))
+        shutil.rmtree(entryDir, ignore_errors=True)
+        removed.append(entryDir)
+
+    return removed
+
+
+#===============================================================================
+#------------------------------------------------------------------ Cohort Store
+#===============================================================================
+# The cohort store keeps one quantity (e.g. the correlation maps) of all
+# subjects and radii of one hemisphere in one .npy file of shape (#verteces,
+# #subjects, #radii) in fortran order. Every map is one contiguous block, and
+# the maps of all subjects at one radius are one (#verteces, #subjects) block
+# that is read as a (#subjects, #verteces) view without copying. A second .npy
+# file flags the maps that were written, a json file holds the subject and
+# radius index. Only one process should write to a store at a time.
+
+
+def cohortStorePaths(storeDir, hemi, quantity):
+    '''
+    Returns the paths to the data, the written flags and the metadata of the
+    store of one quantity and hemisphere
+    '''
+    baseName = os.path.join(storeDir, '%s_%s' % (quantity, hemi))
+    paths = {'data': '%s.npy' % (baseName),
+             'written': '%s_written.npy' % (baseName),
+             'meta': '%s.json' % (baseName)}
+
+    return paths
+
+
+class CohortStore(object):
+    '''
+    The maps of one quantity and hemisphere for all subjects and radii. Use
+    openCohortStore to create or grow a store for writing and
+    loadCohortStore to read one.
+
+    data is the (#verteces, #subjects, #radii) memory map, written flags
+    the (#subjects, #radii) maps that are filled
+    '''
+    def __init__(self, storeDir, hemi, quantity, mode='r'):
+        self.storeDir = storeDir
+        self.hemi = hemi
+        self.quantity = quantity
+        self.paths = cohortStorePaths(storeDir, hemi, quantity)
+        f = open(self.paths['meta'], 'r')
+        self.meta = json.load(f)
+        f.close()
+        self.subjects = [str(subID) for subID in self.meta['subjects']]
+        self.radii = list(self.meta['radii'])
+        self.numberVerteces = self.meta['numberVerteces']
+        self.subjectIndex = dict([(subID, row) for row, subID
+                                  in enumerate(self.subjects)])
+        self.data = np.load(self.paths['data'], mmap_mode=mode)
+        self.written = np.load(self.paths['written'], mmap_mode=mode)
+
+    def write(self, subID, radius, vertVec):
+        '''
+        Writes the map of one subject and radius and flags it as written
+        '''
+        row = self.subjectIndex[subID]
+        column = self.radii.index(radius)
+        self.data[:, row, column] = vertVec
+        self.written[row, column] = 1
+
+    def isWritten(self, subID, radius):
+        '''
+        True if the store holds the map of this subject and radius
+        '''
+        if not subID in self.subjectIndex or not radius in self.radii:
+            return False
+        row = self.subjectIndex[subID]
+
+        return bool(self.written[row, self.radii.index(radius)])
+
+    def stack(self, subjectList, radius):
+        '''
+        Returns the subjects of subjectList that have a map at this radius
+        and their maps as a (#subjects, #verteces) matrix. If these subjects
+        are next to each other in the store, the matrix is a view into the
+        memory map and nothing is copied
+        '''
+        useList = [subID for subID in subjectList
+                   if self.isWritten(subID, radius)]
+        if not useList:
+            return useList, np.zeros((0, self.numberVerteces),
+                                     dtype=self.data.dtype)
+        block = self.data[:, :, self.radii.index(radius)].T
+        rows = [self.subjectIndex[subID] for subID in useList]
+        if rows and rows == list(range(rows[0], rows[0] + len(rows))):
+            maps = block[rows[0]:rows[0] + len(rows)]
+        else:
+            maps = block[rows]
+
+        return useList, maps
+
+    def saveStack(self, subjectList, radius, outPath):
+        '''
+        Writes the maps of the subjects of subjectList that have one at this
+        radius as an mgh stack with one frame per subject (like
+        stackFiles). The maps are copied one at a time from the store into
+        the memory mapped mgh file. Returns the subjects and the path
+        '''
+        useList = [subID for subID in subjectList
+                   if self.isWritten(subID, radius)]
+        if not useList:
+            message = ('There are no maps at radius %s to stack into %s'
+                       % (str(radius), outPath))
+            raise Exception(message)
+        column = self.radii.index(radius)
+        print('Stacking %d maps into %s' % (len(useList), outPath))
+        stack = createMgh(outPath, self.numberVerteces, len(useList))
+        for frame, subID in enumerate(useList):
+            stack[frame] = self.data[:, self.subjectIndex[subID], column]
+        stack.flush()
+        del stack
+
+        return useList, outPath
+
+    def flush(self):
+        '''
+        Writes the changes of the memory maps to disk
+        '''
+        self.data.flush()
+        self.written.flush()
+
+
+def loadCohortStore(storeDir, hemi, quantity):
+    '''
+    Opens the store of one quantity and hemisphere for reading. Returns None
+    if there is no such store
+    '''
+    if not storeDir:
+        return None
+    if not os.path.isfile(cohortStorePaths(storeDir, hemi, quantity)['meta']):
+        return None
+
+    return CohortStore(storeDir, hemi, quantity, mode='r')
+
+
+def openCohortStore(storeDir, hemi, quantity, subjects, radii,
+                    numberVerteces):
+    '''
+    Opens the store of one quantity and hemisphere for writing. If there is
+    no store yet, or it is missing some of the subjects or radii, a new store
+    is made for all of them and the maps of the old one are copied over. A
+    store of a template with a different number of verteces is replaced
+    '''
+    paths = cohortStorePaths(storeDir, hemi, quantity)
+    allSubjects = list(subjects)
+    allRadii = sorted(set(radii))
+    old = None
+    if os.path.isfile(paths['meta']):
+        old = CohortStore(storeDir, hemi, quantity, mode='r')
+        if old.numberVerteces != numberVerteces:
+            print('%s was made for %d verteces, starting a new one'
+                  % (paths['data'], old.numberVerteces))
+            old = None
+        elif (set(subjects) <= set(old.subjects)
+              and set(radii) <= set(old.radii)):
+            return CohortStore(storeDir, hemi, quantity, mode='r+')
+        else:
+            # the old subjects keep their place at the front
+            allSubjects = old.subjects + [subID for subID in subjects
+                                          if not subID in old.subjectIndex]
+            allRadii = sorted(set(radii) | set(old.radii))
+
+    if not os.path.isdir(storeDir):
+        os.makedirs(storeDir)
+    shape = (numberVerteces, len(allSubjects), len(allRadii))
+    print('Making the cohort store %s for %d subjects and %d radii'
+          % (paths['data'], len(allSubjects), len(allRadii)))
+    # Everything is written next to the store first and moved into place at
+    # the end
+    tempPaths = cohortStorePaths(storeDir, hemi, '.%s' % (quantity))
+    data = np.lib.format.open_memmap(tempPaths['data'], mode='w+',
+                                     dtype=np.float32, shape=shape,
+                                     fortran_order=True)
+    written = np.lib.format.open_memmap(tempPaths['written'], mode='w+',
+                                        dtype=np.uint8, shape=shape[1:],
+                                        fortran_order=True)
+    if old is not None:
+        numberOld = len(old.subjects)
+        for oldColumn, radius in enumerate(old.radii):
+            column = allRadii.index(radius)
+            data[:, :numberOld, column] = old.data[:, :, oldColumn]
+            written[:numberOld, column] = old.written[:, oldColumn]
+        del old
+    data.flush()
+    written.flush()
+    del data, written
+    meta = {'hemi': hemi,
+            'quantity': quantity,
+            'subjects': allSubjects,
+            'radii': allRadii,
+            'numberVerteces': numberVerteces}
+    f = open(tempPaths['meta'], 'w')
+    json.dump(meta, f, indent=1)
+    f.close()
+    for field in ['data', 'written', 'meta']:
+        os.rename(tempPaths[field], paths[field])
+
+    return CohortStore(storeDir, hemi, quantity, mode='r+')
+
+
+#===============================================================================
+#---------------------------------------------------------------------- Manifest
+#===============================================================================
+# content hashes of files that were already hashed, keyed by
+# (path, modification time, size)
+_hashMemo = {}
+
+
+def hashFile(path):
+    '''
+    Returns the sha1 hash of the content of a file, or None if the file does
+    not exist. Files that did not change since they were last hashed are not
+    read again
+    '''
+    if not os.path.isfile(path):
+        return None
+    status = os.stat(path)
+    memoKey = (os.path.abspath(path), status.st_mtime, status.st_size)
+    if not memoKey in _hashMemo:
+        hasher = hashlib.sha1()
+        f = open(path, 'rb')
+        chunk = f.read(1024 * 1024)
+        while chunk:
+            hasher.update(chunk)
+            chunk = f.read(1024 * 1024)
+        f.close()
+        _hashMemo[memoKey] = hasher.hexdigest()
+
+    return _hashMemo[memoKey]
+
+
+def hashFiles(paths):
+    '''
+    Returns one sha1 hash over the names and contents of a list of files
+    '''
+    hasher = hashlib.sha1()
+    for path in paths:
+        hasher.update(('%s %s\n' % (path, hashFile(path))).encode('utf-8'))
+
+    return hasher.hexdigest()
+
+
+def loadManifest(manifestPath):
+    '''
+    Loads the job records of a manifest file. Returns an empty dictionary if
+    there is no manifest yet
+    '''
+    if not manifestPath or not os.path.isfile(manifestPath):
+        return {}
+    f = open(manifestPath, 'r')
+    manifest = json.load(f)
+    f.close()
+
+    return manifest.get('jobs', {})
+
+
+def updateManifest(manifestPath, records):
+    '''
+    Adds or replaces job records in the manifest file. The manifest is read
+    again right before writing so records of other jobs are kept, and it is
+    replaced in one step so an interrupted run never leaves a broken file
+    '''
+    jobs = loadManifest(manifestPath)
+    jobs.update(records)
+    manifestDir = os.path.dirname(os.path.abspath(manifestPath))
+    if not os.path.isdir(manifestDir):
+        os.makedirs(manifestDir)
+    handle, tempPath = tempfile.mkstemp(prefix='.manifest_', dir=manifestDir)
+    f = os.fdopen(handle, 'w')
+    json.dump({'jobs': jobs}, f, indent=1, sort_keys=True)
+    f.close()
+    os.rename(tempPath, manifestPath)
+
+    return manifestPath
+
+
 if __name__ == '__main__':
     pass
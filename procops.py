@@ -6,12 +6,22 @@ Created on Jul 18, 2013
 This contains all computation operations
 
 '''
+import os
+import time
+import shutil
+import tempfile
 import subprocess
 import numpy as np
-import networkx as nx
 import multiprocessing
+from scipy import sparse as ss
 from scipy import stats as st
-from nipy.labs import utils as nu
+from scipy.sparse import csgraph as csg
+from scipy.sparse import linalg as ssl
+from scipy.spatial import cKDTree
+try:
+    import gdist
+except ImportError:
+    gdist = None
 
 
 def computeDistance(vertexLocations, vertex1, vertex2):
@@ -38,59 +48,617 @@ def work(cmd):
 
 def buildGraph(surface, weighted=True):
     '''
-    This method generates the graph by generating edges between known nodes
-    and weighting them by their distance
+    This method generates the graph as a sparse adjacency matrix by generating
+    edges between known nodes and weighting them by their distance
+
+    The edges are collected from all triangles in one go, redundant edges are
+    dropped and the result is stored as a symmetric scipy CSR matrix of shape
+    (#verteces, #verteces). Rows and columns are indexed by vertex ID.
     '''
     # Load values from the surface
-    numberVertices = len(surface[0])
-    vertexLocations = surface[0]
-    numberTriangles = len(surface[1])
-    vertexTriangles = surface[1]
-
-    # Generate the (empty) Graph
-    graph = nx.Graph()
-
-    # Loop through all the triangles, this is going to include redundant
-    # edges but we don't care
-    for triangle in vertexTriangles:
-        # get the verteces that make up the triangle
-        vertex1 = triangle[0]
-        vertex2 = triangle[1]
-        vertex3 = triangle[2]
-
-        if weighted:
-            # get the distances
-            distance12 = computeDistance(vertexLocations, vertex1, vertex2)
-            distance13 = computeDistance(vertexLocations, vertex1, vertex3)
-            distance23 = computeDistance(vertexLocations, vertex2, vertex3)
-        else:
-            distance12, distance13, distance23 = (1, 1, 1)
+    vertexLocations = np.asarray(surface[0])
+    vertexTriangles = np.asarray(surface[1])
+    numberVertices = len(vertexLocations)
+
+    # Every triangle contributes the edges 0-1, 0-2 and 1-2
+    edges = np.vstack((vertexTriangles[:, [0, 1]],
+                       vertexTriangles[:, [0, 2]],
+                       vertexTriangles[:, [1, 2]]))
+    # Sort the vertex pairs so that shared edges look the same, then drop
+    # the redundant ones
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+
+    if weighted:
+        # get the distances
+        offset = vertexLocations[edges[:, 0]] - vertexLocations[edges[:, 1]]
+        distances = np.sqrt(np.sum(np.square(offset), axis=1))
+    else:
+        distances = np.ones(len(edges))
 
-        # and generate the edges
-        graph.add_edge(vertex1, vertex2, weight=distance12)
-        graph.add_edge(vertex1, vertex3, weight=distance13)
-        graph.add_edge(vertex2, vertex3, weight=distance23)
+    # and generate the edges in both directions
+    rows = np.concatenate((edges[:, 0], edges[:, 1]))
+    cols = np.concatenate((edges[:, 1], edges[:, 0]))
+    weights = np.concatenate((distances, distances))
+    graph = ss.csr_matrix((weights, (rows, cols)),
+                          shape=(numberVertices, numberVertices))
 
     return graph, numberVertices
 
 
-def buildNeighbors(graph, cutoff, source=None):
+class NeighbourIndex(object):
+    '''
+    Flat storage of the neighbourhoods of a set of source verteces.
+
+    The neighbours of vertex v are indices[indptr[v]:indptr[v + 1]] and their
+    geodesic distances to v are stored at the same positions in distances.
+    Within each neighbourhood, the neighbours are sorted by distance so the
+    neighbourhood for any smaller radius is a prefix of it.
+    Verteces that are not a source have an empty neighbourhood.
+
+    The rows don't have to be verteces: the windows can also be parcels of
+    the surface. numberTargets is then the number of surface verteces the
+    indices point to, by default it is the number of rows.
+    '''
+    def __init__(self, indptr, indices, distances, radius,
+                 numberTargets=None):
+        # indptr is kept as int64 so large meshes and radii can't overflow it
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.distances = np.asarray(distances, dtype=np.float32)
+        self.radius = radius
+        self.numberVerteces = len(self.indptr) - 1
+        if numberTargets is None:
+            numberTargets = self.numberVerteces
+        self.numberTargets = numberTargets
+        self._rowIds = None
+        self._operators = {}
+
+    def sizes(self):
+        '''
+        returns the number of neighbours of every vertex
+        '''
+        return np.diff(self.indptr)
+
+    def sources(self):
+        '''
+        returns the verteces that have a neighbourhood
+        '''
+        return np.flatnonzero(self.sizes())
+
+    def rowIds(self):
+        '''
+        returns the source vertex of every entry in the flat arrays
+        '''
+        if self._rowIds is None:
+            self._rowIds = np.repeat(np.arange(self.numberVerteces,
+                                               dtype=np.int32),
+                                     self.sizes())
+        return self._rowIds
+
+    def neighbours(self, vertex):
+        '''
+        returns the neighbours of a single vertex
+        '''
+        vertex = int(vertex)
+        return self.indices[self.indptr[vertex]:self.indptr[vertex + 1]]
+
+    def neighbourDistances(self, vertex):
+        '''
+        returns the distances of the neighbours of a single vertex
+        '''
+        vertex = int(vertex)
+        return self.distances[self.indptr[vertex]:self.indptr[vertex + 1]]
+
+    def atRadius(self, radius):
+        '''
+        returns the NeighbourIndex for a smaller radius. Because the
+        neighbours are sorted by distance, this only cuts every neighbourhood
+        short and needs no new graph search
+        '''
+        if radius >= self.radius:
+            return self
+        within = self.distances <= radius
+        counts = np.bincount(self.rowIds()[within],
+                             minlength=self.numberVerteces)
+        indptr = np.zeros(self.numberVerteces + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        neighbourIndex = NeighbourIndex(indptr, self.indices[within],
+                                        self.distances[within], radius,
+                                        numberTargets=self.numberTargets)
+
+        return neighbourIndex
+
+    def operator(self, weighting='binary', sigma=None):
+        '''
+        returns the neighbourhoods as a sparse (#rows, #targets) matrix
+        whose rows are the windows around each vertex. With
+        weighting='binary' every neighbour has a weight of 1, with
+        weighting='gaussian' the weights fall off with the geodesic distance
+        as exp(-d^2 / (2 * sigma^2)). sigma defaults to half the radius.
+        Multiplying a vector with it gives the (weighted) sum over every
+        window
+        '''
+        if sigma is None:
+            sigma = self.radius / 2.0
+        key = (weighting, sigma)
+        if not key in self._operators:
+            if weighting == 'binary':
+                weights = np.ones(len(self.indices))
+            elif weighting == 'gaussian':
+                distances = self.distances.astype(float)
+                weights = np.exp(-np.square(distances) / (2.0 * sigma ** 2))
+            else:
+                message = ('The weighting %s is not implemented.'
+                           % (weighting))
+                raise Exception(message)
+            self._operators[key] = ss.csr_matrix((weights, self.indices,
+                                                  self.indptr),
+                                                 shape=(self.numberVerteces,
+                                                        self.numberTargets))
+
+        return self._operators[key]
+
+    def gather(self, vector):
+        '''
+        returns the values of vector for all neighbourhoods at once, ordered
+        like the flat index arrays. The values of vertex v are then found at
+        gather(vector)[indptr[v]:indptr[v + 1]]
+        '''
+        return np.asarray(vector)[..., self.indices]
+
+
+def buildNeighbors(graph, cutoff, source=None, blockSize=256, method='graph',
+                   surface=None, workers=1):
     '''
-    This method returns a dictionary keyed by node source index that contains
-    another dictionary keyed by target node index. The values are the weighted
-    shortest path lengths from source to target that are below a certain
-    cutoff value
+    This method returns a NeighbourIndex holding, for every source node, the
+    target nodes whose geodesic distance from the source is below a certain
+    cutoff value, together with those distances
 
     if a source is set, then neighbours are only calculated for this node
+    (or list of nodes), otherwise for all nodes in the graph. Sources are
+    processed in blocks of blockSize verteces to keep the dense distance
+    rows small. With workers > 1, the blocks are spread over a pool of
+    processes that write their results into shared memory buffers, only the
+    neighbourhood sizes are sent back. This works for all methods, every
+    worker sets up its own distance computation.
+
+    The geodesic distances are computed with one of these methods:
+        - 'graph': weighted shortest paths along the edges of the graph
+        - 'heat': the heat method on the triangles of the surface
+        - 'exact': exact geodesics on the triangles of the surface (needs
+          the gdist package)
+    For 'heat' and 'exact' the surface has to be supplied and only triangles
+    whose verteces are all still connected in the graph are used.
+
+    The neighbours of every source are sorted by their distance, so the
+    neighbourhoods of smaller radii can be taken from the result with
+    NeighbourIndex.atRadius instead of running this again.
+    '''
+    numberVerteces = graph.shape[0]
+    if source is None:
+        sources = np.arange(numberVerteces)
+    else:
+        sources = np.unique(np.atleast_1d(source).astype(int))
+    blocks = [sources[start:start + blockSize]
+              for start in range(0, len(sources), blockSize)]
+
+    print('Begin calculating for %d nodes with radius %.2f.'
+          % (len(sources), cutoff))
+    if workers > 1 and len(blocks) > 1:
+        indptr, indices, distances = parallelNeighbors(graph, cutoff, method,
+                                                       surface, blocks,
+                                                       workers)
+    else:
+        distanceFunc = neighbourDistanceFunc(graph, cutoff, method, surface)
+        rowList = []
+        indexList = []
+        distanceList = []
+        for block in blocks:
+            rows, targets, targetDistances = neighbourBlock(distanceFunc,
+                                                            cutoff, block)
+            rowList.append(block[rows])
+            indexList.append(targets)
+            distanceList.append(targetDistances)
+
+        if rowList:
+            rows = np.concatenate(rowList)
+            indices = np.concatenate(indexList)
+            distances = np.concatenate(distanceList)
+        else:
+            rows = indices = np.zeros(0, dtype=int)
+            distances = np.zeros(0)
+        indptr = np.zeros(numberVerteces + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=numberVerteces))
+    print('Done calculating for %d nodes with radius %.2f.'
+          % (len(sources), cutoff))
+    neighbourIndex = NeighbourIndex(indptr, indices, distances, cutoff)
+
+    return neighbourIndex
+
+
+def neighbourDistanceFunc(graph, cutoff, method='graph', surface=None):
+    '''
+    returns a function that takes a block of source verteces and returns the
+    dense (#block, #verteces) array of their geodesic distances to all
+    verteces, computed with the given method (see buildNeighbors)
     '''
-    if source:
-        distanceDict = nx.single_source_dijkstra(graph, source, cutoff)
+    # verteces that were removed from the graph don't have any edges left
+    mask = np.flatnonzero(np.diff(graph.tocsr().indptr))
+    if method == 'graph':
+        distanceFunc = lambda block: csg.dijkstra(graph, directed=False,
+                                                  indices=block, limit=cutoff)
+    elif method == 'heat':
+        solver = HeatGeodesics(surface, mask=mask)
+        distanceFunc = solver.distances
+    elif method == 'exact':
+        distanceFunc = exactDistanceFunc(surface, cutoff, mask=mask)
     else:
-        print('Begin calculating for all nodes with radius %.2f.' % (cutoff))
-        distanceDict = nx.all_pairs_dijkstra_path_length(graph, cutoff)
-        print('Done calculating for all nodes with radius %.2f.' % (cutoff))
+        message = ('The geodesic method %s is not implemented.' % (method))
+        raise Exception(message)
+
+    return distanceFunc
+
+
+def neighbourBlock(distanceFunc, cutoff, block):
+    '''
+    computes the neighbourhoods of a block of source verteces. Returns the
+    position of the source in the block, the neighbour and the distance for
+    every neighbour, sorted by source first and then by distance
+    '''
+    distances = distanceFunc(block)
+    rows, targets = np.nonzero(distances <= cutoff)
+    targetDistances = distances[rows, targets]
+    order = np.lexsort((targets, targetDistances, rows))
+
+    return rows[order], targets[order], targetDistances[order]
+
+
+# state of a worker process of parallelNeighbors, set up by
+# _initNeighbourWorker when the worker starts
+_workerState = {}
+
+
+def _initNeighbourWorker(graph, cutoff, method, surface, outDir):
+    '''
+    sets up a worker process of parallelNeighbors. Every worker makes its own
+    distance function (e.g. factorizes the heat method), so this works with
+    any start method of multiprocessing, not only with fork
+    '''
+    _workerState['distanceFunc'] = neighbourDistanceFunc(graph, cutoff,
+                                                         method, surface)
+    _workerState['cutoff'] = cutoff
+    _workerState['outDir'] = outDir
+
+
+def _neighbourWorker(job):
+    '''
+    computes one block of neighbourhoods in a worker process and writes it
+    into the shared memory directory. Only the neighbourhood sizes are
+    returned to the parent
+    '''
+    blockNumber, block = job
+    distanceFunc = _workerState['distanceFunc']
+    rows, targets, distances = neighbourBlock(distanceFunc,
+                                              _workerState['cutoff'], block)
+    outBase = os.path.join(_workerState['outDir'], 'block_%06d' % blockNumber)
+    np.save('%s_indices.npy' % outBase, targets.astype(np.int32))
+    np.save('%s_distances.npy' % outBase, distances.astype(np.float32))
+    counts = np.bincount(rows, minlength=len(block)).astype(np.int64)
+
+    return blockNumber, counts
+
+
+def parallelNeighbors(graph, cutoff, method, surface, blocks, workers):
+    '''
+    computes the neighbourhoods of all blocks in a pool of worker processes.
+    The graph, the method and the surface are handed to the workers when
+    they start, and each computes its blocks with its own distance function
+    (see buildNeighbors). Every worker writes its block straight into a
+    buffer in shared memory (/dev/shm where available) and the parent
+    assembles the flat arrays from them. Returns indptr, indices and
+    distances
+    '''
+    numberVerteces = graph.shape[0]
+    shmDir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    outDir = tempfile.mkdtemp(prefix='neighbours_', dir=shmDir)
+    try:
+        pool = multiprocessing.Pool(workers, initializer=_initNeighbourWorker,
+                                    initargs=(graph, cutoff, method, surface,
+                                              outDir))
+        try:
+            results = pool.map(_neighbourWorker, list(enumerate(blocks)),
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        counts = np.zeros(numberVerteces, dtype=np.int64)
+        for blockNumber, blockCounts in results:
+            counts[blocks[blockNumber]] = blockCounts
+        indptr = np.zeros(numberVerteces + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        distances = np.empty(indptr[-1], dtype=np.float32)
+        # the blocks hold increasing sources, so they go in one after the
+        # other
+        position = 0
+        for blockNumber in range(len(blocks)):
+            outBase = os.path.join(outDir, 'block_%06d' % blockNumber)
+            blockIndices = np.load('%s_indices.npy' % outBase, mmap_mode='r')
+            blockDistances = np.load('%s_distances.npy' % outBase,
+                                     mmap_mode='r')
+            stop = position + len(blockIndices)
+            indices[position:stop] = blockIndices
+            distances[position:stop] = blockDistances
+            position = stop
+            del blockIndices, blockDistances
+    finally:
+        shutil.rmtree(outDir, ignore_errors=True)
+
+    return indptr, indices, distances
+
+
+#===============================================================================
+#-------------------------------------------------------------------- Geodesics
+#===============================================================================
+def maskFaces(surface, mask=None):
+    '''
+    returns the triangles of the surface whose verteces are all in the mask
+    '''
+    faces = np.asarray(surface[1])
+    if mask is None:
+        return faces
+    keep = np.zeros(len(surface[0]), dtype=bool)
+    keep[np.asarray(mask, dtype=int)] = True
+    faces = faces[np.all(keep[faces], axis=1)]
+
+    return faces
+
+
+def cotanOperators(vertexLocations, faces):
+    '''
+    Builds the cotan Laplacian (negative semi-definite) and the lumped mass
+    matrix of a triangle mesh. Also returns the cotangents of the three
+    angles of every triangle
+    '''
+    numberVerteces = len(vertexLocations)
+    corners = [vertexLocations[faces[:, i]] for i in range(3)]
+    cotans = np.zeros((len(faces), 3))
+    for i in range(3):
+        # angle at corner i is opposite the edge between the other two
+        edge1 = corners[(i + 1) % 3] - corners[i]
+        edge2 = corners[(i + 2) % 3] - corners[i]
+        cross = np.sqrt(np.sum(np.square(np.cross(edge1, edge2)), axis=1))
+        cotans[:, i] = np.sum(edge1 * edge2, axis=1) / np.maximum(cross,
+                                                                  1e-12)
+
+    rows = []
+    cols = []
+    weights = []
+    for i in range(3):
+        j = (i + 1) % 3
+        k = (i + 2) % 3
+        # the edge between j and k is opposite the angle at i
+        rows.extend([faces[:, j], faces[:, k]])
+        cols.extend([faces[:, k], faces[:, j]])
+        weights.extend([cotans[:, i] / 2, cotans[:, i] / 2])
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    weights = np.concatenate(weights)
+    laplacian = ss.csr_matrix((weights, (rows, cols)),
+                              shape=(numberVerteces, numberVerteces))
+    laplacian = laplacian - ss.diags(np.asarray(laplacian.sum(axis=1))
+                                     .ravel())
+
+    areas = np.sqrt(np.sum(np.square(np.cross(corners[1] - corners[0],
+                                              corners[2] - corners[0])),
+                           axis=1)) / 2
+    vertexAreas = np.bincount(faces.ravel(), weights=np.repeat(areas, 3) / 3,
+                              minlength=numberVerteces)
+    mass = ss.diags(vertexAreas)
+
+    return laplacian.tocsc(), mass.tocsc(), cotans
+
+
+class HeatGeodesics(object):
+    '''
+    Geodesic distances on a triangle mesh with the heat method (Crane et al.,
+    2013). Both sparse systems are factorized once when the object is created
+    and then reused for every source. The sources are solved chunkSize at a
+    time, the gradient and divergence of a chunk hold (#faces, 3, chunkSize)
+    and (#verteces, chunkSize) floats.
+    '''
+    def __init__(self, surface, mask=None, timeFactor=1.0, chunkSize=16):
+        self.chunkSize = max(1, int(chunkSize))
+        self.vertexLocations = np.asarray(surface[0], dtype=float)
+        self.faces = maskFaces(surface, mask)
+        self.numberVerteces = len(self.vertexLocations)
+        laplacian, mass, self.cotans = cotanOperators(self.vertexLocations,
+                                                      self.faces)
+
+        # verteces without triangles are kept out of both systems
+        used = np.zeros(self.numberVerteces, dtype=bool)
+        used[self.faces.ravel()] = True
+        unused = ss.diags((~used).astype(float))
+
+        # the time step is the squared mean edge length
+        edges = (self.vertexLocations[self.faces[:, [0, 1, 2]]]
+                 - self.vertexLocations[self.faces[:, [1, 2, 0]]])
+        meanEdge = np.mean(np.sqrt(np.sum(np.square(edges), axis=2)))
+        timeStep = timeFactor * meanEdge ** 2
+        self.heatSolver = ssl.splu((mass - timeStep * laplacian
+                                    + unused).tocsc())
+
+        # the poisson problem is only defined up to a constant for each
+        # connected part of the mesh, so one vertex of each part is pinned
+        adjacency = ss.csr_matrix((np.ones(self.faces.size),
+                                   (self.faces.ravel(),
+                                    self.faces[:, [1, 2, 0]].ravel())),
+                                  shape=(self.numberVerteces,
+                                         self.numberVerteces))
+        numberParts, self.parts = csg.connected_components(adjacency,
+                                                           directed=False)
+        pinned = np.zeros(self.numberVerteces, dtype=bool)
+        pinned[np.unique(self.parts, return_index=True)[1]] = True
+        pinned |= ~used
+        keep = ss.diags((~pinned).astype(float))
+        poisson = keep.dot(-laplacian).dot(keep) + ss.diags(pinned
+                                                            .astype(float))
+        self.poissonSolver = ssl.splu(poisson.tocsc())
+        self.pinned = pinned
+        self.used = used
+
+    def distances(self, sources):
+        '''
+        returns a (#sources, #verteces) array of the geodesic distances from
+        every source to every vertex. Verteces that are not connected to a
+        source get an infinite distance
+        '''
+        sources = np.atleast_1d(sources)
+        distances = np.empty((len(sources), self.numberVerteces))
+        for start in range(0, len(sources), self.chunkSize):
+            stop = start + self.chunkSize
+            distances[start:stop] = self.chunkDistances(sources[start:stop])
+
+        return distances
+
+    def chunkDistances(self, sources):
+        '''
+        returns the distances of a chunk of sources, see distances
+        '''
+        numberSources = len(sources)
+        # step 1: let heat flow from the sources for one time step
+        impulses = np.zeros((self.numberVerteces, numberSources))
+        impulses[sources, np.arange(numberSources)] = 1
+        heat = self.heatSolver.solve(impulses)
+
+        # step 2: normalized negative gradient of the heat on every triangle
+        faces = self.faces
+        corners = [self.vertexLocations[faces[:, i]] for i in range(3)]
+        normals = np.cross(corners[1] - corners[0], corners[2] - corners[0])
+        doubleAreas = np.sqrt(np.sum(np.square(normals), axis=1))
+        normals = normals / np.maximum(doubleAreas, 1e-12)[:, None]
+        gradient = np.zeros((len(faces), 3, numberSources))
+        for i in range(3):
+            # edge opposite to corner i, counter-clockwise
+            opposite = corners[(i + 2) % 3] - corners[(i + 1) % 3]
+            direction = np.cross(normals, opposite)
+            gradient += direction[:, :, None] * heat[faces[:, i]][:, None, :]
+        gradient /= np.maximum(doubleAreas, 1e-12)[:, None, None]
+        lengths = np.sqrt(np.sum(np.square(gradient), axis=1))
+        field = -gradient / np.maximum(lengths, 1e-300)[:, None, :]
 
-    return distanceDict
+        # step 3: integrated divergence of the field on every vertex
+        divergence = np.zeros((self.numberVerteces, numberSources))
+        for i in range(3):
+            j = (i + 1) % 3
+            k = (i + 2) % 3
+            edge1 = corners[j] - corners[i]
+            edge2 = corners[k] - corners[i]
+            flux = (self.cotans[:, k][:, None]
+                    * np.sum(edge1[:, :, None] * field, axis=1)
+                    + self.cotans[:, j][:, None]
+                    * np.sum(edge2[:, :, None] * field, axis=1)) / 2
+            np.add.at(divergence, faces[:, i], flux)
+
+        # step 4: recover the distance from the divergence
+        divergence[self.pinned] = 0
+        potential = self.poissonSolver.solve(-divergence)
+        distances = (potential - potential[sources, np.arange(numberSources)])
+        distances = np.maximum(distances, 0).T
+        distances[:, ~self.used] = np.inf
+        sameParts = self.parts[None, :] == self.parts[sources][:, None]
+        distances[~sameParts] = np.inf
+        distances[np.arange(numberSources), sources] = 0
+
+        return distances
+
+
+def exactDistanceFunc(surface, cutoff, mask=None):
+    '''
+    returns a function that takes a block of source verteces and returns the
+    dense (#block, #verteces) array of their exact geodesic distances,
+    infinite beyond cutoff. Every source is computed on its own, so the
+    blocks can be spread over workers. This needs the gdist package
+    '''
+    if gdist is None:
+        message = ('The exact geodesics need the gdist package, please '
+                   'install it or use another method')
+        raise Exception(message)
+    vertexLocations = np.asarray(surface[0], dtype=np.float64)
+    faces = maskFaces(surface, mask).astype(np.int32)
+
+    def distanceFunc(block):
+        distances = np.inf * np.ones((len(block), len(vertexLocations)))
+        for row, source in enumerate(block):
+            sourceIndex = np.array([source], dtype=np.int32)
+            sourceDistances = gdist.compute_gdist(vertexLocations, faces,
+                                                  source_indices=sourceIndex,
+                                                  max_distance=cutoff)
+            within = sourceDistances <= cutoff
+            distances[row, within] = sourceDistances[within]
+        distances[np.arange(len(block)), block] = 0
+        return distances
+
+    return distanceFunc
+
+
+def compareGeodesics(surface, cutoff, sources, mask=None,
+                     methods=('heat', 'exact')):
+    '''
+    Compares the geodesic methods against the graph distances on the same
+    mesh. For each method, the runtime for the given sources and the error
+    of the distances to all verteces that are within the cutoff for both the
+    graph and the method are reported. Methods that can't run are skipped.
+
+    returns a dictionary keyed by method name
+    '''
+    sources = np.atleast_1d(sources).astype(int)
+    graph, numberVerteces = buildGraph(surface, weighted=True)
+    if mask is not None:
+        graph = keepNodes(graph, mask)
+
+    report = {}
+    startTime = time.time()
+    reference = buildNeighbors(graph, cutoff, source=sources)
+    report['graph'] = {'time': time.time() - startTime,
+                       'size': np.mean(reference.sizes()[sources])}
+    for method in methods:
+        startTime = time.time()
+        try:
+            result = buildNeighbors(graph, cutoff, source=sources,
+                                    method=method, surface=surface)
+        except Exception as error:
+            print('Skipping %s: %s' % (method, str(error)))
+            continue
+        runTime = time.time() - startTime
+
+        errors = []
+        for vertex in sources:
+            refDistances = np.inf * np.ones(numberVerteces)
+            refDistances[reference.neighbours(vertex)] = \
+                reference.neighbourDistances(vertex)
+            targets = result.neighbours(vertex)
+            within = np.isfinite(refDistances[targets])
+            errors.append(result.neighbourDistances(vertex)[within]
+                          - refDistances[targets[within]])
+        errors = np.concatenate(errors)
+        report[method] = {'time': runTime,
+                          'size': np.mean(result.sizes()[sources]),
+                          'meanError': np.mean(errors),
+                          'meanAbsError': np.mean(np.abs(errors)),
+                          'maxAbsError': np.max(np.abs(errors))}
+
+    print('method  time (s)  mean size  mean error  mean abs error')
+    for method in ['graph'] + list(methods):
+        if not method in report:
+            continue
+        values = report[method]
+        print('%-7s %8.2f %10.1f %11.3f %15.3f'
+              % (method, values['time'], values['size'],
+                 values.get('meanError', 0), values.get('meanAbsError', 0)))
+
+    return report
 
 
 def findNonZeros(surface, vector):
@@ -119,17 +687,18 @@ def findNonZeros(surface, vector):
 def keepNodes(graph, vertecesToKeep):
     '''
     Method keeps only the specified verteces in the graph
+
+    The graph keeps its shape so that vertex IDs stay valid, all edges to and
+    from the removed verteces are dropped
     '''
-    count = 0
+    vertecesToKeep = np.asarray(vertecesToKeep, dtype=int)
     print('Begin removing nodes from Graph. Will keep %d of %d nodes'
-          % (len(vertecesToKeep), len(graph.nodes())))
-    # find the nodes that are not in the the vertexList
-    graphNodeSet = set(graph.nodes())
-    vertexSet = set(vertecesToKeep)
-    removeNodes = np.array(list(graphNodeSet - vertexSet))
-    graph.remove_nodes_from(removeNodes)
-
-    print('removed %d verteces' % (len(removeNodes)))
+          % (len(vertecesToKeep), graph.shape[0]))
+    keepMask = np.zeros(graph.shape[0])
+    keepMask[vertecesToKeep] = 1
+    graph = maskGraph(graph, keepMask)
+
+    print('removed %d verteces' % (graph.shape[0] - len(vertecesToKeep)))
     return graph
 
 
@@ -137,7 +706,20 @@ def removeNodes(graph, vertecesToRemove):
     '''
     Method removes the specified verteces from the graph
     '''
-    graph.remove_nodes_from(vertecesToRemove)
+    keepMask = np.ones(graph.shape[0])
+    keepMask[np.asarray(vertecesToRemove, dtype=int)] = 0
+    graph = maskGraph(graph, keepMask)
+
+    return graph
+
+
+def maskGraph(graph, keepMask):
+    '''
+    Drops all edges of the graph that touch a vertex where keepMask is 0
+    '''
+    maskMatrix = ss.diags(keepMask)
+    graph = maskMatrix.dot(graph).dot(maskMatrix).tocsr()
+    graph.eliminate_zeros()
 
     return graph
 
@@ -147,90 +729,568 @@ def getRoiMorph(neighbours, morphVec):
     Method that returns a set of morphometric values for verteces in the set
     of neighbours (ROI)
     '''
-    morphVals = morphVec[map(int, neighbours)]
+    morphVals = morphVec[np.asarray(neighbours, dtype=int)]
 
     return morphVals
 
 
-def getScore(valSet, score, valSet2=None):
-    '''
-    Gets the score for one or two sets of values. Currently implemented are:
-    for single sets:
-        - sum
-        - mean
-        - SD
-    for two sets:
-        - pearson r
-        - z-scored p-value for pearson r
-    '''
-    if score == 'sum':
-        return np.sum(valSet)
-
-    elif score == 'mean':
-        return np.mean(valSet)
-    elif score == 'sd':
-        return np.std(valSet)
-    elif score == 'pearsonr':
-        r, p = st.pearsonr(valSet, valSet2)
-        if np.isnan(r):
-            r = 0
-        return r
-    elif score == 'spearmanr':
-        r, p = st.spearmanr(valSet, valSet2)
-        if np.isnan(r):
-            r = 0
-        return r
-    elif score == 'zpear':
-        r, p = st.pearsonr(valSet, valSet2)
-        k = 0
-        if np.isnan(r):
-            k = 0
-        elif np.isnan(p):
-            k = 0
-        elif np.isnan(nu.zscore(p)):
-            k = 0
-        elif r > 0:
-            k = nu.zscore(p)
-        elif r < 0:
-            k = -nu.zscore(p)
-        return k
-    elif score == 'zspear':
-        r, p = st.spearmanr(valSet, valSet2)
-        k = 0
-        if np.isnan(r):
-            k = 0
-        elif np.isnan(p):
-            k = 0
-        elif np.isnan(nu.zscore(p)):
-            k = 0
-        elif r > 0:
-            k = nu.zscore(p)
-        elif r < 0:
-
-            k = -nu.zscore(p)
-        return k
-
-
-def slideRoiValues(numberVerteces, verteces, neighbourDict,
-                   morphVec, morphVec2=None, score='zspear'):
+# p-values are kept this far away from 0 and 1 before they are turned into
+# z-scores (same as nipy.labs.utils.zscore)
+TINY = 1e-15
+
+
+def pToZ(pValues):
+    '''
+    Returns the z-scores corresponding to (arrays of) p-values. The p-values
+    are clipped to [TINY, 1 - TINY] first, so the z-scores stay finite
+    '''
+    pValues = np.minimum(np.maximum(pValues, TINY), 1. - TINY)
+    zValues = st.norm.isf(pValues)
+
+    return zValues
+
+
+def correlationPValues(r, counts, score='pearsonr'):
+    '''
+    Computes the two-sided p-values of correlation coefficients r that were
+    each computed from counts values, using the t distribution with
+    counts - 2 degrees of freedom. This works on whole arrays and follows
+    scipy.stats: perfect pearson correlations get p = 0, spearman
+    correlations from less than 3 values get NaN.
+    '''
+    r = np.asarray(r, dtype=float)
+    degrees = np.asarray(counts, dtype=float) - 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tValues = r * np.sqrt(degrees / ((1.0 - r) * (1.0 + r)))
+        pValues = 2 * st.t.sf(np.abs(tValues), degrees)
+    perfect = np.abs(r) == 1
+    if score == 'pearsonr':
+        pValues = np.where(perfect, 0., pValues)
+    else:
+        pValues = np.where(perfect & (degrees > 0), 0., pValues)
+        pValues = np.where(degrees > 0, pValues, np.nan)
+
+    return pValues
+
+
+def signedZ(r, pValues):
+    '''
+    Turns correlation coefficients and their p-values into z-scores that
+    carry the sign of the correlation. Undefined correlations or p-values
+    and correlations of exactly 0 get 0
+    '''
+    zValues = pToZ(pValues)
+    signedValues = np.where(r > 0, zValues, -zValues)
+    signedValues = np.where((r == 0) | np.isnan(r) | np.isnan(pValues), 0.,
+                            signedValues)
+
+    return signedValues
+
+
+def segmentSum(values, indptr):
+    '''
+    Sums flat values (like the ones returned by NeighbourIndex.gather) over
+    the segments defined by indptr. Returns one sum per segment, empty
+    segments sum to 0. Leading dimensions of values are kept.
+    '''
+    values = np.asarray(values, dtype=float)
+    counts = np.diff(indptr)
+    sums = np.zeros(values.shape[:-1] + (len(counts),))
+    nonEmpty = counts > 0
+    if np.any(nonEmpty):
+        # skipping the empty segments makes every start run up to the next
+        # start, which is exactly the end of its own segment
+        sums[..., nonEmpty] = np.add.reduceat(values,
+                                              indptr[:-1][nonEmpty], axis=-1)
+
+    return sums
+
+
+def segmentMean(values, indptr):
+    '''
+    Averages flat values over the segments defined by indptr and returns the
+    means spread back to the positions of the flat values, so they can be
+    subtracted right away
+    '''
+    counts = np.diff(indptr)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = segmentSum(values, indptr) / counts
+
+    return np.repeat(means, counts, axis=-1)
+
+
+def segmentPearson(xVals, yVals, indptr):
+    '''
+    Computes the pearson correlation between two sets of flat values inside
+    every segment defined by indptr. Segments where the correlation is not
+    defined get NaN.
+    '''
+    # center both sets of values on their segment means first, this is more
+    # accurate than the raw sums of products
+    xVals = np.asarray(xVals, dtype=float)
+    yVals = np.asarray(yVals, dtype=float)
+    xVals = xVals - segmentMean(xVals, indptr)
+    yVals = yVals - segmentMean(yVals, indptr)
+
+    sumXY = segmentSum(xVals * yVals, indptr)
+    sumXX = segmentSum(np.square(xVals), indptr)
+    sumYY = segmentSum(np.square(yVals), indptr)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = sumXY / np.sqrt(sumXX * sumYY)
+    r = np.clip(r, -1, 1)
+
+    return r
+
+
+def segmentRank(values, indptr):
+    '''
+    Ranks flat values within every segment defined by indptr, starting at 1.
+    Tied values get the average of their ranks and NaN values get a NaN rank.
+    Leading dimensions of values are ranked separately.
+    '''
+    values = np.asarray(values, dtype=float)
+    numberValues = values.shape[-1]
+    counts = np.diff(indptr)
+    numberBatches = int(np.prod(values.shape[:-1]))
+    # give every segment of every batch its own key and sort by key first
+    # and by value second
+    segmentKeys = (np.arange(numberBatches)[:, None] * len(counts)
+                   + np.repeat(np.arange(len(counts)), counts)[None, :])
+    segmentKeys = segmentKeys.ravel()
+    flatValues = values.reshape(-1)
+    order = np.lexsort((flatValues, segmentKeys))
+    sortedKeys = segmentKeys[order]
+    sortedValues = flatValues[order]
+
+    # position of every sorted value within its segment
+    segmentStarts = (np.arange(numberBatches)[:, None] * numberValues
+                     + indptr[:-1][None, :]).ravel()
+    positions = np.arange(len(order)) - segmentStarts[sortedKeys]
+
+    # runs of tied values share the average of their positions
+    newRun = np.ones(len(order), dtype=bool)
+    newRun[1:] = ((sortedKeys[1:] != sortedKeys[:-1])
+                  | (sortedValues[1:] != sortedValues[:-1]))
+    runStarts = np.flatnonzero(newRun)
+    runStops = np.append(runStarts[1:], len(order)) - 1
+    runRanks = (positions[runStarts] + positions[runStops]) / 2.0 + 1
+    sortedRanks = runRanks[np.cumsum(newRun) - 1]
+
+    ranks = np.empty(len(order))
+    ranks[order] = sortedRanks
+    ranks[np.isnan(flatValues)] = np.nan
+
+    return ranks.reshape(values.shape)
+
+
+def batchPearson(neighbourIndex, morphVec, morphVec2):
+    '''
+    Computes the pearson correlation between two vectors inside every
+    neighbourhood of the NeighbourIndex at once. Neighbourhoods where the
+    correlation is not defined get 0, like in getScore.
+
+    returns a vector of # verteces with the correlation coefficients
+    '''
+    r = segmentPearson(neighbourIndex.gather(morphVec),
+                       neighbourIndex.gather(morphVec2),
+                       neighbourIndex.indptr)
+    r[np.isnan(r)] = 0
+
+    return r
+
+
+def batchSpearman(neighbourIndex, morphVec, morphVec2):
+    '''
+    Computes the spearman correlation between two vectors inside every
+    neighbourhood of the NeighbourIndex at once by ranking the values within
+    each neighbourhood and correlating the ranks. Neighbourhoods where the
+    correlation is not defined get 0, like in getScore.
+
+    returns a vector of # verteces with the correlation coefficients
+    '''
+    indptr = neighbourIndex.indptr
+    xRanks = segmentRank(neighbourIndex.gather(morphVec), indptr)
+    yRanks = segmentRank(neighbourIndex.gather(morphVec2), indptr)
+    r = segmentPearson(xRanks, yRanks, indptr)
+    r[np.isnan(r)] = 0
+
+    return r
+
+
+def batchZScore(neighbourIndex, morphVec, morphVec2, score='zspear'):
+    '''
+    Computes the signed z-score of the correlation p-value between two
+    vectors inside every neighbourhood of the NeighbourIndex at once. score
+    is either 'zpear' (pearson) or 'zspear' (spearman).
+
+    returns a vector of # verteces with the z-scores
+    '''
+    indptr = neighbourIndex.indptr
+    counts = neighbourIndex.sizes()
+    xVals = neighbourIndex.gather(morphVec)
+    yVals = neighbourIndex.gather(morphVec2)
+    if score == 'zspear':
+        method = 'spearmanr'
+        xVals = segmentRank(xVals, indptr)
+        yVals = segmentRank(yVals, indptr)
+    else:
+        method = 'pearsonr'
+    r = segmentPearson(xVals, yVals, indptr)
+    # two values always correlate perfectly, don't let rounding hide that
+    r = np.where(counts == 2, np.sign(r), r)
+    pValues = correlationPValues(r, counts, score=method)
+    zValues = signedZ(r, pValues)
+
+    return zValues
+
+
+def applyOperator(operator, vectors):
+    '''
+    Multiplies a sparse neighbourhood operator with a vector or with every
+    row of a (#maps, #verteces) matrix in one sparse x dense product
+    '''
+    vectors = np.asarray(vectors, dtype=float)
+    flat = vectors.reshape(-1, vectors.shape[-1]).T
+    result = np.asarray(operator.dot(flat)).T
+
+    return result.reshape(vectors.shape[:-1] + (operator.shape[0],))
+
+
+def windowSum(neighbourIndex, vectors, weighting='binary', sigma=None):
+    '''
+    Computes the (weighted) sum of every window for one or many vectors
+    '''
+    operator = neighbourIndex.operator(weighting, sigma)
+    sums = applyOperator(operator, vectors)
+
+    return sums
+
+
+def windowMean(neighbourIndex, vectors, weighting='binary', sigma=None):
+    '''
+    Computes the (weighted) mean of every window for one or many vectors.
+    Empty windows get NaN
+    '''
+    operator = neighbourIndex.operator(weighting, sigma)
+    totalWeights = np.asarray(operator.sum(axis=1)).ravel()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = applyOperator(operator, vectors) / totalWeights
+
+    return means
+
+
+def windowSd(neighbourIndex, vectors, weighting='binary', sigma=None):
+    '''
+    Computes the (weighted) standard deviation of every window for one or
+    many vectors, like np.std for binary weights. Empty windows get NaN
+    '''
+    vectors = np.asarray(vectors, dtype=float)
+    means = windowMean(neighbourIndex, vectors, weighting, sigma)
+    squareMeans = windowMean(neighbourIndex, np.square(vectors), weighting,
+                             sigma)
+    sds = np.sqrt(np.maximum(squareMeans - np.square(means), 0))
+
+    return sds
+
+
+def batchSum(neighbourIndex, morphVec, morphVec2=None, covariate=None):
+    '''
+    Sums the values of a vector inside every neighbourhood at once
+    '''
+    return windowSum(neighbourIndex, morphVec)
+
+
+def batchMean(neighbourIndex, morphVec, morphVec2=None, covariate=None):
+    '''
+    Averages the values of a vector inside every neighbourhood at once
+    '''
+    return windowMean(neighbourIndex, morphVec)
+
+
+def batchSd(neighbourIndex, morphVec, morphVec2=None, covariate=None):
+    '''
+    Computes the standard deviation (like np.std) of the values of a vector
+    inside every neighbourhood at once
+    '''
+    return windowSd(neighbourIndex, morphVec)
+
+
+def batchCovariance(neighbourIndex, morphVec, morphVec2, covariate=None):
+    '''
+    Computes the sample covariance (like np.cov) between two vectors inside
+    every neighbourhood at once. Neighbourhoods with less than two verteces
+    get 0
+    '''
+    indptr = neighbourIndex.indptr
+    xVals = neighbourIndex.gather(morphVec).astype(float)
+    yVals = neighbourIndex.gather(morphVec2).astype(float)
+    xVals = xVals - segmentMean(xVals, indptr)
+    yVals = yVals - segmentMean(yVals, indptr)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariances = (segmentSum(xVals * yVals, indptr)
+                       / (neighbourIndex.sizes() - 1))
+    covariances[~np.isfinite(covariances)] = 0
+
+    return covariances
+
+
+def batchPartialPearson(neighbourIndex, morphVec, morphVec2, covariate):
+    '''
+    Computes the pearson correlation between two vectors inside every
+    neighbourhood at once while controlling for a third, covariate vector
+    (for example curvature). Undefined correlations get 0
+    '''
+    indptr = neighbourIndex.indptr
+    xVals = neighbourIndex.gather(morphVec)
+    yVals = neighbourIndex.gather(morphVec2)
+    zVals = neighbourIndex.gather(covariate)
+    rXY = segmentPearson(xVals, yVals, indptr)
+    rXZ = segmentPearson(xVals, zVals, indptr)
+    rYZ = segmentPearson(yVals, zVals, indptr)
+    r = partialFromPearson(rXY, rXZ, rYZ)
+
+    return r
+
+
+def partialFromPearson(rXY, rXZ, rYZ):
+    '''
+    Combines three pairwise pearson correlations into the partial correlation
+    of x and y given z. Undefined correlations get 0
+    '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = (rXY - rXZ * rYZ) / np.sqrt((1 - np.square(rXZ))
+                                        * (1 - np.square(rYZ)))
+    r = np.clip(r, -1, 1)
+    r = np.where(np.isfinite(r), r, 0.)
+
+    return r
+
+
+#===============================================================================
+#----------------------------------------------------------------------- Scores
+#===============================================================================
+def scalarPearson(valSet, valSet2, covSet=None):
+    r, p = st.pearsonr(valSet, valSet2)
+    if np.isnan(r):
+        r = 0
+    return r
+
+
+def scalarSpearman(valSet, valSet2, covSet=None):
+    r, p = st.spearmanr(valSet, valSet2)
+    if np.isnan(r):
+        r = 0
+    return r
+
+
+def scalarZPear(valSet, valSet2, covSet=None):
+    r, p = st.pearsonr(valSet, valSet2)
+    k = float(signedZ(r, p))
+    return k
+
+
+def scalarZSpear(valSet, valSet2, covSet=None):
+    r, p = st.spearmanr(valSet, valSet2)
+    k = float(signedZ(r, p))
+    return k
+
+
+def scalarKendall(valSet, valSet2, covSet=None):
+    tau, p = st.kendalltau(valSet, valSet2)
+    if np.isnan(tau):
+        tau = 0
+    return tau
+
+
+def scalarCovariance(valSet, valSet2, covSet=None):
+    if len(valSet) < 2:
+        return 0
+    return np.cov(valSet, valSet2)[0, 1]
+
+
+def scalarPartialPearson(valSet, valSet2, covSet):
+    rXY = st.pearsonr(valSet, valSet2)[0]
+    rXZ = st.pearsonr(valSet, covSet)[0]
+    rYZ = st.pearsonr(valSet2, covSet)[0]
+    return float(partialFromPearson(rXY, rXZ, rYZ))
+
+
+# All scores that slideRoiValues and getScore know about, keyed by name.
+# Use registerScore to add new ones
+scoreRegistry = {}
+
+
+def registerScore(name, description, kernel=None, scalar=None, paired=True,
+                  covariate=False):
+    '''
+    Adds a score to the registry.
+
+    kernel computes the score for all neighbourhoods at once and is called as
+    kernel(neighbourIndex, morphVec, morphVec2, covariate). It has to work
+    along the last axis of the inputs so batches of maps can be scored.
+    scalar computes the score for the values of one neighbourhood and is
+    called as scalar(valSet, valSet2, covSet). It is used when there is no
+    kernel. paired scores need two vectors, covariate scores also need a
+    covariate vector.
+    '''
+    if kernel is None and scalar is None:
+        message = ('Score %s needs a kernel or a scalar function' % (name))
+        raise Exception(message)
+    scoreRegistry[name] = {'description': description,
+                           'kernel': kernel,
+                           'scalar': scalar,
+                           'paired': paired,
+                           'covariate': covariate}
+
+
+def describeScores():
+    '''
+    Returns the list of registered scores as it appears in the readme file
+    '''
+    lines = []
+    for name in sorted(scoreRegistry.keys()):
+        description = scoreRegistry[name]['description']
+        lines.append('\'%s\': %s  ' % (name, description))
+
+    return '\n'.join(lines)
+
+
+registerScore('sum', 'sum of the overlay in the window (single vector)',
+              kernel=batchSum, scalar=lambda valSet, *args: np.sum(valSet),
+              paired=False)
+registerScore('mean', 'mean of the overlay in the window (single vector)',
+              kernel=batchMean, scalar=lambda valSet, *args: np.mean(valSet),
+              paired=False)
+registerScore('sd', 'standard deviation of the overlay in the window '
+              '(single vector)',
+              kernel=batchSd, scalar=lambda valSet, *args: np.std(valSet),
+              paired=False)
+registerScore('wsum', 'distance weighted (gaussian, sigma = radius / 2) sum '
+              'of the overlay in the window (single vector)',
+              kernel=lambda index, x, y=None, z=None: windowSum(index, x,
+                                                                'gaussian'),
+              paired=False)
+registerScore('wmean', 'distance weighted (gaussian, sigma = radius / 2) '
+              'mean of the overlay in the window (single vector)',
+              kernel=lambda index, x, y=None, z=None: windowMean(index, x,
+                                                                 'gaussian'),
+              paired=False)
+registerScore('wsd', 'distance weighted (gaussian, sigma = radius / 2) '
+              'standard deviation of the overlay in the window (single '
+              'vector)',
+              kernel=lambda index, x, y=None, z=None: windowSd(index, x,
+                                                               'gaussian'),
+              paired=False)
+registerScore('pearsonr', 'pearson correlation between gradient and overlay',
+              kernel=lambda index, x, y, z=None: batchPearson(index, x, y),
+              scalar=scalarPearson)
+registerScore('spearmanr', 'spearman correlation between gradient and '
+              'overlay',
+              kernel=lambda index, x, y, z=None: batchSpearman(index, x, y),
+              scalar=scalarSpearman)
+registerScore('zpear', 'z-score of correlation p-value of pearson '
+              'correlation',
+              kernel=lambda index, x, y, z=None: batchZScore(index, x, y,
+                                                             score='zpear'),
+              scalar=scalarZPear)
+registerScore('zspear', 'z-score of correlation p-value of spearman '
+              'correlation',
+              kernel=lambda index, x, y, z=None: batchZScore(index, x, y,
+                                                             score='zspear'),
+              scalar=scalarZSpear)
+registerScore('covariance', 'covariance between gradient and overlay',
+              kernel=batchCovariance, scalar=scalarCovariance)
+registerScore('kendalltau', 'kendall tau between gradient and overlay',
+              scalar=scalarKendall)
+registerScore('partialr', 'pearson correlation between gradient and overlay '
+              'controlling for a covariate (e.g. curvature)',
+              kernel=batchPartialPearson, scalar=scalarPartialPearson,
+              covariate=True)
+
+
+def getScore(valSet, score, valSet2=None, covSet=None):
+    '''
+    Gets the score for one or two sets of values. The available scores are
+    the ones in the scoreRegistry, see describeScores()
+    '''
+    if not score in scoreRegistry:
+        message = ('The score %s is not implemented. Choose one of %s'
+                   % (score, ', '.join(sorted(scoreRegistry.keys()))))
+        raise Exception(message)
+    entry = scoreRegistry[score]
+    if entry['scalar'] is None:
+        # use the kernel on a single neighbourhood that holds all values.
+        # Their distances are not known here, so they all get the same weight
+        numberValues = len(valSet)
+        indptr = np.array([0, numberValues])
+        neighbourIndex = NeighbourIndex(indptr, np.arange(numberValues),
+                                        np.zeros(numberValues), np.inf,
+                                        numberTargets=numberValues)
+        return float(entry['kernel'](neighbourIndex, valSet, valSet2,
+                                     covSet)[0])
+
+    return entry['scalar'](valSet, valSet2, covSet)
+
+
+def slideRoiValues(numberVerteces, verteces, neighbourIndex,
+                   morphVec, morphVec2=None, score='zspear', covariate=None):
     '''
     Method that loops through all verteces in the surface and gets the
-    morphometry values from its neighbours.
+    morphometry values from its neighbours in the NeighbourIndex.
+
+    morphVec and morphVec2 can also be matrices of (#maps, #verteces), for
+    example one row per subject, or several overlays against one gradient
+    vector. The neighbourhoods are then gathered once for the whole batch
+    and the result is a matrix with one row of scores per map.
+
+    The score is looked up in the scoreRegistry. Scores with a kernel are
+    computed for all verteces at once, the others go through their scalar
+    function one vertex at a time. If only one vector is supplied and the
+    score needs two, the neighbourhood sum is computed instead.
 
     returns a vector of # verteces with the summed scores of the neighbours
     '''
-    outVec = np.zeros(numberVerteces)
+    if not score in scoreRegistry:
+        message = ('The score %s is not implemented. Choose one of %s'
+                   % (score, ', '.join(sorted(scoreRegistry.keys()))))
+        raise Exception(message)
+    if morphVec2 is None and scoreRegistry[score]['paired']:
+        score = 'sum'
+    entry = scoreRegistry[score]
+    if not entry['paired']:
+        morphVec2 = None
+    if entry['covariate'] and covariate is None:
+        message = ('The score %s needs a covariate' % (score))
+        raise Exception(message)
+    if not entry['covariate']:
+        covariate = None
 
-    for vertex in verteces:
-        neighbours = neighbourDict[int(vertex)].keys()
-        neighbourVals = getRoiMorph(neighbours, morphVec)
-        if not morphVec2 == None:
-            neighbourVals2 = getRoiMorph(neighbours, morphVec2)
-            vertexVal = getScore(neighbourVals, score,
-                                 valSet2=neighbourVals2)
-        else:
-            vertexVal = getScore(neighbourVals, 'sum')
-        outVec[int(vertex)] = vertexVal
+    inputs = [np.asarray(vector) for vector in (morphVec, morphVec2,
+                                                covariate)
+              if vector is not None]
+    batchShape = np.broadcast(*[vector[..., 0] for vector in inputs]).shape
+    outVec = np.zeros(batchShape + (numberVerteces,))
+    verteces = np.asarray(verteces, dtype=int)
+
+    if entry['kernel'] is not None:
+        scores = entry['kernel'](neighbourIndex, morphVec, morphVec2,
+                                 covariate)
+        outVec[..., verteces] = np.broadcast_to(scores, outVec.shape)[...,
+                                                                  verteces]
+        return outVec
+
+    indptr = neighbourIndex.indptr
+    # gather the values of all neighbourhoods in one go
+    roiVals = [np.broadcast_to(neighbourIndex.gather(vector),
+                               batchShape + neighbourIndex.indices.shape)
+               for vector in inputs]
+    scalar = entry['scalar']
+
+    for batch in np.ndindex(*batchShape):
+        for vertex in verteces:
+            start, stop = indptr[vertex], indptr[vertex + 1]
+            neighbourVals = [vals[batch][start:stop] for vals in roiVals]
+            outVec[batch][vertex] = scalar(*neighbourVals)
 
     return outVec
 
@@ -238,10 +1298,11 @@ def slideRoiValues(numberVerteces, verteces, neighbourDict,
 def mapBack(vector, indices, numberOriginalVerteces):
     '''
     This maps back a vector of a truncated graph into the original graph size
-    by using a list of vertex indices
+    by using a list of vertex indices. Leading dimensions of the vector are
+    kept
     '''
-    outVector = np.zeros(numberOriginalVerteces)
-    outVector[indices] = vector
+    outVector = np.zeros(np.shape(vector)[:-1] + (numberOriginalVerteces,))
+    outVector[..., indices] = vector
 
     return outVector
 
@@ -274,5 +1335,297 @@ def maskVector(vector, mask):
     return maskedVector
 
 
+
+#===============================================================================
+#----------------------------------------------------------------------- Parcels
+#===============================================================================
+
+def parcelMeans(values, parcelIds, numberParcels=None):
+    '''
+    Averages values within every parcel. parcelIds holds the parcel of every
+    vertex, verteces outside of all parcels are marked with -1. Leading
+    dimensions of values are kept, so a batch of subjects is averaged in one
+    go. Returns the means and the number of verteces per parcel; parcels
+    without verteces have a mean of 0.
+    '''
+    values = np.asarray(values, dtype=float)
+    parcelIds = np.asarray(parcelIds)
+    if numberParcels is None:
+        numberParcels = int(parcelIds.max()) + 1
+    inParcel = parcelIds >= 0
+    ids = parcelIds[inParcel]
+    counts = np.bincount(ids, minlength=numberParcels)
+
+    # offset every row of the batch so a single bincount does all of them
+    flatVals = values[..., inParcel].reshape(-1, len(ids))
+    numberRows = flatVals.shape[0]
+    rowIds = (ids[np.newaxis, :]
+              + numberParcels * np.arange(numberRows)[:, np.newaxis])
+    sums = np.bincount(rowIds.ravel(), weights=flatVals.ravel(),
+                       minlength=numberRows * numberParcels)
+    sums = sums.reshape(values.shape[:-1] + (numberParcels,))
+    means = np.zeros_like(sums)
+    np.divide(sums, counts, out=means, where=counts > 0)
+
+    return means, counts
+
+
+def parcelMap(values, parcelIds, numberParcels=None):
+    '''
+    Replaces the value of every vertex by the mean of its parcel. Verteces
+    outside of all parcels are set to 0
+    '''
+    means, counts = parcelMeans(values, parcelIds, numberParcels)
+
+    return spreadParcels(means, parcelIds)
+
+
+def spreadParcels(parcelValues, parcelIds, fill=0):
+    '''
+    Writes one value per parcel back to all verteces of the parcel. Verteces
+    outside of all parcels are set to fill. Leading dimensions of
+    parcelValues are kept
+    '''
+    parcelValues = np.asarray(parcelValues, dtype=float)
+    parcelIds = np.asarray(parcelIds)
+    # give the verteces without a parcel an extra parcel that is always fill
+    padded = np.concatenate([parcelValues,
+                             np.zeros(parcelValues.shape[:-1] + (1,)) + fill],
+                            axis=-1)
+    outVec = padded[..., np.where(parcelIds >= 0, parcelIds, -1)]
+
+    return outVec
+
+
+def buildParcelIndex(parcelIds, numberParcels=None, keepVerteces=None,
+                     graph=None, radius=0):
+    '''
+    Returns a NeighbourIndex with one window per parcel instead of one per
+    vertex, so the scores can be computed for every parcel directly.
+
+    Without a radius, the window of a parcel holds its own verteces. With a
+    radius and a graph, the parcel is dilated by all verteces whose geodesic
+    distance to the closest vertex of the parcel is below the radius, and
+    the distances to the parcel are stored (0 inside the parcel). Smaller
+    radii can then be taken from the result with NeighbourIndex.atRadius.
+    If keepVerteces is set, only those verteces are used.
+    '''
+    parcelIds = np.asarray(parcelIds)
+    numberTargets = len(parcelIds)
+    if numberParcels is None:
+        numberParcels = int(parcelIds.max()) + 1
+    inMask = parcelIds >= 0
+    if keepVerteces is not None:
+        keepMask = np.zeros(numberTargets, dtype=bool)
+        keepMask[np.asarray(keepVerteces, dtype=int)] = True
+        inMask &= keepMask
+
+    indexList = []
+    distanceList = []
+    for parcel in range(numberParcels):
+        members = np.flatnonzero(inMask & (parcelIds == parcel))
+        if radius > 0 and graph is not None and len(members) > 0:
+            # distance to the closest member, a chunk of members at a time
+            # (dijkstra has no min_only before scipy 1.3)
+            distances = np.inf
+            for start in range(0, len(members), 256):
+                chunk = members[start:start + 256]
+                chunkDistances = csg.dijkstra(graph, indices=chunk,
+                                              limit=radius)
+                distances = np.minimum(distances, chunkDistances.min(axis=0))
+            targets = np.flatnonzero(distances <= radius)
+            if keepVerteces is not None:
+                targets = targets[keepMask[targets]]
+            # sort by distance so the smaller radii are prefixes
+            order = np.argsort(distances[targets], kind='mergesort')
+            targets = targets[order]
+            distances = distances[targets]
+        else:
+            targets = members
+            distances = np.zeros(len(members))
+        indexList.append(targets)
+        distanceList.append(distances)
+
+    indptr = np.zeros(numberParcels + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(targets) for targets in indexList])
+    if numberParcels > 0:
+        indices = np.concatenate(indexList)
+        distances = np.concatenate(distanceList)
+    else:
+        indices = np.zeros(0, dtype=int)
+        distances = np.zeros(0)
+    if not radius > 0 or graph is None:
+        # the plain parcels don't depend on the radius
+        radius = np.inf
+    parcelIndex = NeighbourIndex(indptr, indices, distances, radius,
+                                 numberTargets=numberTargets)
+
+    return parcelIndex
+
+
+#===============================================================================
+#------------------------------------------------------------------- Null Models
+#===============================================================================
+
+def randomRotations(number, randomState=None):
+    '''
+    Returns number uniformly distributed random 3D rotation matrices as a
+    (number, 3, 3) array
+    '''
+    if randomState is None:
+        randomState = np.random.RandomState()
+    rotations = np.zeros((number, 3, 3))
+    for rot in range(number):
+        # the QR decomposition of a gaussian matrix is uniform once the
+        # signs of the diagonal are fixed
+        q, r = np.linalg.qr(randomState.normal(size=(3, 3)))
+        q = q * np.sign(np.diag(r))
+        if np.linalg.det(q) < 0:
+            q[:, 0] = -q[:, 0]
+        rotations[rot] = q
+
+    return rotations
+
+
+def spinNull(sphereCoords, keepVerteces=None, seed=None):
+    '''
+    Returns a function that draws spin surrogates: draw(number) returns a
+    (number, #verteces) index matrix. Indexing a map with one of its rows
+    gives the map rotated on the sphere, every vertex takes the value of the
+    vertex closest to its rotated position. This keeps the spatial
+    autocorrelation of the map.
+
+    If keepVerteces is set, values are only taken from those verteces, so
+    nothing from the medial wall is rotated into the cortex.
+    '''
+    sphereCoords = np.asarray(sphereCoords, dtype=float)
+    if keepVerteces is None:
+        keepVerteces = np.arange(len(sphereCoords))
+    keepVerteces = np.asarray(keepVerteces, dtype=int)
+    # rotate about the center of the whole sphere (the origin for freesurfer
+    # spheres), not of the cortex, so the verteces stay on the sphere
+    center = sphereCoords.mean(axis=0)
+    coords = sphereCoords - center
+    tree = cKDTree(coords[keepVerteces])
+    randomState = np.random.RandomState(seed)
+
+    def draw(number):
+        rotations = randomRotations(number, randomState)
+        nullIndices = np.zeros((number, len(coords)), dtype=np.int32)
+        for rot in range(number):
+            # rotating the sphere and looking up the closest vertex is the
+            # same as looking up the inversely rotated verteces
+            distances, closest = tree.query(coords.dot(rotations[rot]))
+            nullIndices[rot] = keepVerteces[closest]
+        return nullIndices
+
+    return draw
+
+
+def shuffleNull(numberVerteces, keepVerteces=None, seed=None):
+    '''
+    Returns a function that draws shuffle surrogates: draw(number) returns a
+    (number, #verteces) index matrix that randomly permutes the values
+    between the verteces in keepVerteces (or all verteces). This destroys
+    the spatial autocorrelation of the map.
+    '''
+    if keepVerteces is None:
+        keepVerteces = np.arange(numberVerteces)
+    keepVerteces = np.asarray(keepVerteces, dtype=int)
+    randomState = np.random.RandomState(seed)
+
+    def draw(number):
+        nullIndices = np.tile(np.arange(numberVerteces, dtype=np.int32),
+                              (number, 1))
+        for perm in range(number):
+            nullIndices[perm, keepVerteces] = randomState.permutation(
+                keepVerteces)
+        return nullIndices
+
+    return draw
+
+
+def permutationPValues(numberVerteces, verteces, neighbourIndex, morphVec,
+                       morphVec2=None, score='zspear', covariate=None,
+                       drawNull=None, numberPermutations=1000, chunkSize=100,
+                       parcelIds=None, numberParcels=None):
+    '''
+    Computes empirical two-sided p-values of the slideRoiValues map against
+    surrogates of morphVec2 (or of morphVec for unpaired scores) drawn with
+    drawNull (see spinNull and shuffleNull). Without drawNull, the values
+    are shuffled between the verteces of morphVec.
+
+    The surrogates are scored chunkSize at a time as one batch through the
+    neighbourhoods, so the memory only depends on chunkSize and not on the
+    number of permutations. morphVec and morphVec2 can be batches like in
+    slideRoiValues, every map gets the same surrogates.
+
+    If parcelIds are supplied, the p-values of the parcel means of the map
+    are computed from the same surrogates as well.
+
+    returns the observed map, the p-values of every vertex and the p-values
+    of every parcel (None without parcelIds)
+    '''
+    observed = slideRoiValues(numberVerteces, verteces, neighbourIndex,
+                              morphVec, morphVec2=morphVec2, score=score,
+                              covariate=covariate)
+
+    # the surrogates get their own axis in front of the verteces
+    fixed = [np.asarray(vector)[..., np.newaxis, :]
+             if vector is not None else None
+             for vector in (morphVec, morphVec2, covariate)]
+    permuteSecond = (morphVec2 is not None
+                     and scoreRegistry[score]['paired'])
+    if permuteSecond:
+        permuted = np.asarray(morphVec2)
+    else:
+        permuted = np.asarray(morphVec)
+    if drawNull is None:
+        # The surrogates index the values and not the scored windows, which
+        # are parcels instead of verteces when the parcels are scored
+        if permuted.shape[-1] == numberVerteces:
+            drawNull = shuffleNull(numberVerteces, verteces)
+        else:
+            drawNull = shuffleNull(permuted.shape[-1])
+    observedMagnitude = np.abs(observed)[..., np.newaxis, :]
+    exceedances = np.zeros(observed.shape)
+    if parcelIds is not None:
+        observedParcels = parcelMeans(observed, parcelIds, numberParcels)[0]
+        parcelMagnitude = np.abs(observedParcels)[..., np.newaxis, :]
+        parcelExceedances = np.zeros(observedParcels.shape)
+
+    done = 0
+    while done < numberPermutations:
+        number = min(chunkSize, numberPermutations - done)
+        nullIndices = drawNull(number)
+        # batch + (number, #verteces)
+        surrogates = permuted[..., nullIndices]
+        if permuteSecond:
+            inputs = [fixed[0], surrogates]
+        else:
+            inputs = [surrogates, fixed[1]]
+        nullMaps = slideRoiValues(numberVerteces, verteces, neighbourIndex,
+                                  inputs[0], morphVec2=inputs[1],
+                                  score=score, covariate=fixed[2])
+        # nan scores never count as exceeding the observed one
+        with np.errstate(invalid='ignore'):
+            exceedances += np.sum(np.abs(nullMaps) >= observedMagnitude,
+                                  axis=-2)
+            if parcelIds is not None:
+                nullParcels = parcelMeans(nullMaps, parcelIds,
+                                          numberParcels)[0]
+                parcelExceedances += np.sum(np.abs(nullParcels)
+                                            >= parcelMagnitude, axis=-2)
+        done += number
+
+    pValues = (exceedances + 1) / float(numberPermutations + 1)
+    parcelPValues = None
+    if parcelIds is not None:
+        parcelPValues = ((parcelExceedances + 1)
+                         / float(numberPermutations + 1))
+
+    return observed, pValues, parcelPValues
+
 if __name__ == '__main__':
-    pass
+    # print the list of scores for the readme file
+    print(describeScores())
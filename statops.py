@@ -0,0 +1,477 @@
+'''
+This contains the statistics for the group analysis of the surface maps
+
+'''
+import numpy as np
+from scipy import stats as st
+from scipy.sparse import csgraph as csg
+import surfaceProcessing as sp
+
+
+#===============================================================================
+#------------------------------------------------------------------------ Meshes
+#===============================================================================
+
+def vertexAreas(surface):
+    '''
+    Returns the area that belongs to every vertex of the surface: a third of
+    the area of all triangles it is part of
+    '''
+    vertexLocations = np.asarray(surface[0], dtype=float)
+    faces = np.asarray(surface[1], dtype=int)
+    edge1 = vertexLocations[faces[:, 1]] - vertexLocations[faces[:, 0]]
+    edge2 = vertexLocations[faces[:, 2]] - vertexLocations[faces[:, 0]]
+    faceAreas = 0.5 * np.sqrt(np.sum(np.square(np.cross(edge1, edge2)),
+                                     axis=1))
+    areas = np.bincount(faces.ravel(), weights=np.repeat(faceAreas, 3),
+                        minlength=len(vertexLocations)) / 3.0
+
+    return areas
+
+
+def meshAdjacency(surface, keepVerteces=None):
+    '''
+    Returns the unweighted adjacency matrix of the surface. If keepVerteces
+    is set, only their rows and columns are returned, in the order of
+    keepVerteces
+    '''
+    graph, numberVerteces = sp.procops.buildGraph(surface, weighted=False)
+    if keepVerteces is not None:
+        keepVerteces = np.asarray(keepVerteces, dtype=int)
+        graph = graph[keepVerteces][:, keepVerteces]
+
+    return graph
+
+
+#===============================================================================
+#--------------------------------------------------------------- One Sample Test
+#===============================================================================
+
+def signFlipT(data, flips):
+    '''
+    Returns the one-sample t-values against 0 of data (#subjects, #verteces)
+    after multiplying the subjects with every row of flips (#flips,
+    #subjects) of +1 and -1. The sum of squares doesn't change with the
+    signs, so all flips are done with one matrix product. Verteces without
+    any variance get a t-value of 0.
+    '''
+    data = np.asarray(data, dtype=float)
+    flips = np.atleast_2d(flips)
+    numberSubjects = data.shape[0]
+    means = flips.dot(data) / numberSubjects
+    sumSquares = np.sum(np.square(data), axis=0)
+    variance = ((sumSquares - numberSubjects * np.square(means))
+                / (numberSubjects - 1))
+    standardError = np.sqrt(np.maximum(variance, 0) / numberSubjects)
+    tValues = np.zeros_like(means)
+    np.divide(means, standardError, out=tValues, where=standardError > 0)
+
+    return tValues
+
+
+def oneSampleT(data):
+    '''
+    Returns the one-sample t-values against 0 of data (#subjects,
+    #verteces) and their degrees of freedom
+    '''
+    numberSubjects = np.asarray(data).shape[0]
+    tValues = signFlipT(data, np.ones((1, numberSubjects)))[0]
+
+    return tValues, numberSubjects - 1
+
+
+def tToZ(tValues, df):
+    '''
+    Returns the signed z-values that have the same one-sided p-values as the
+    t-values
+    '''
+    pValues = st.t.sf(np.abs(tValues), df)
+    zValues = np.sign(tValues) * sp.procops.pToZ(pValues)
+
+    return zValues
+
+
+#===============================================================================
+#---------------------------------------------------------------------- Clusters
+#===============================================================================
+
+def findClusters(adjacency, supra, weights=None):
+    '''
+    Finds the connected clusters of the supra threshold verteces. Returns
+    the cluster of every vertex (-1 if it is not in one) and the size of
+    every cluster. The size is the sum of the weights of its verteces, or
+    the number of its verteces without weights.
+    '''
+    clusterIds = np.zeros(len(supra), dtype=int) - 1
+    members = np.flatnonzero(supra)
+    if len(members) == 0:
+        return clusterIds, np.zeros(0)
+    subGraph = adjacency[members][:, members]
+    numberClusters, labels = csg.connected_components(subGraph,
+                                                      directed=False)
+    clusterIds[members] = labels
+    if weights is None:
+        memberWeights = None
+    else:
+        memberWeights = np.asarray(weights)[members]
+    clusterSizes = np.bincount(labels, weights=memberWeights,
+                               minlength=numberClusters).astype(float)
+
+    return clusterIds, clusterSizes
+
+
+def maxClusterSizes(adjacency, zMaps, zThresh, sign=1, weights=None):
+    '''
+    Returns the size of the largest cluster of every z-map (#maps,
+    #verteces) for the given sign. Maps without a cluster give 0
+    '''
+    maxSizes = np.zeros(len(zMaps))
+    for row, zMap in enumerate(zMaps):
+        clusterIds, clusterSizes = findClusters(adjacency,
+                                                sign * zMap > zThresh,
+                                                weights)
+        if len(clusterSizes) > 0:
+            maxSizes[row] = clusterSizes.max()
+
+    return maxSizes
+
+
+def clusterTest(data, adjacency, vertexThresh=2.0, clustThresh=0.05,
+                posneg='both', numberPermutations=5000, chunkSize=100,
+                weights=None, seed=None):
+    '''
+    One-sample test against 0 of data (#subjects, #verteces) with cluster
+    wise correction by sign flip permutations.
+
+    Like mri_glmfit-sim, vertexThresh is the cluster forming threshold as
+    -log10(p) of the one-sided vertex p-value and posneg ('pos', 'neg' or
+    'both') sets the signs that are tested. Clusters are the connected
+    components of the supra threshold verteces on adjacency, their size is
+    the sum of the weights (the vertex areas for example) of their
+    verteces. The cluster p-values come from the distribution of the
+    largest cluster over the sign flips, which are done chunkSize at a
+    time.
+
+    returns a dictionary with the maps
+        - 't', 'z': the t-values and the matching z-values
+        - 'sig': the signed -log10(p) of the two-sided vertex p-values
+        - 'clusterIds': the number of every significant cluster (p <
+          clustThresh) at its verteces, 0 elsewhere
+        - 'clusterSig': the signed -log10(p) of the cluster p-value at the
+          verteces of every significant cluster, 0 elsewhere (like the
+          cluster-wise sig map of mri_glmfit-sim)
+    and under 'clusters' a list with a dictionary for every cluster. The
+    'members' and the 'peakVertex' of the clusters are columns of data, not
+    verteces of the surface if data was masked (see clusterTable)
+    '''
+    signSets = {'pos': [1], 'neg': [-1], 'both': [1, -1]}
+    if not posneg in signSets:
+        message = ('You supplied a silly command for the contrast sign: %s'
+                   % (str(posneg)))
+        raise Exception(message)
+    signs = signSets[posneg]
+    data = np.asarray(data, dtype=float)
+    numberSubjects, numberVerteces = data.shape
+    randomState = np.random.RandomState(seed)
+
+    tValues, df = oneSampleT(data)
+    zValues = tToZ(tValues, df)
+    zThresh = st.norm.isf(10 ** -float(vertexThresh))
+    sigValues = -np.log10(np.minimum(1, 2 * st.t.sf(np.abs(tValues), df)))
+    sigValues = np.sign(tValues) * sigValues
+
+    # Distribution of the largest cluster under random sign flips
+    nullSizes = dict((sign, np.zeros(numberPermutations)) for sign in signs)
+    done = 0
+    while done < numberPermutations:
+        number = min(chunkSize, numberPermutations - done)
+        flips = randomState.choice([-1., 1.], size=(number, numberSubjects))
+        nullZ = tToZ(signFlipT(data, flips), df)
+        for sign in signs:
+            nullSizes[sign][done:done + number] = maxClusterSizes(adjacency,
+                                                                  nullZ,
+                                                                  zThresh,
+                                                                  sign,
+                                                                  weights)
+        done += number
+
+    clusterIds = np.zeros(numberVerteces, dtype=int)
+    clusterSig = np.zeros(numberVerteces)
+    clusters = []
+    for sign in signs:
+        signIds, signSizes = findClusters(adjacency, sign * zValues > zThresh,
+                                          weights)
+        for cluster, size in enumerate(signSizes):
+            members = np.flatnonzero(signIds == cluster)
+            exceedances = np.sum(nullSizes[sign] >= size)
+            pValue = (exceedances + 1) / float(numberPermutations + 1)
+            peak = members[np.argmax(sign * zValues[members])]
+            if pValue < clustThresh:
+                clusterSig[members] = sign * -np.log10(pValue)
+            info = {'sign': sign,
+                    'numberVerteces': len(members),
+                    'size': size,
+                    'peakVertex': peak,
+                    'peakZ': zValues[peak],
+                    'p': pValue,
+                    'members': members}
+            clusters.append(info)
+
+    # Number the significant clusters from the largest to the smallest
+    clusters.sort(key=lambda info: -info['size'])
+    clusterNumber = 0
+    for info in clusters:
+        info['id'] = 0
+        if info['p'] < clustThresh:
+            clusterNumber += 1
+            info['id'] = clusterNumber
+            clusterIds[info['members']] = clusterNumber
+
+    results = {'t': tValues,
+               'z': zValues,
+               'sig': sigValues,
+               'clusterIds': clusterIds,
+               'clusterSig': clusterSig,
+               'clusters': clusters}
+
+    return results
+
+
+def clusterTable(clusters, verteces=None):
+    '''
+    Returns a text table of the clusters found by clusterTest. The peak
+    verteces of clusterTest are positions in the columns of its data. If the
+    data only held some verteces of the surface (e.g. the cortex mask), pass
+    these verteces so the table gives the peaks as verteces of the surface
+    '''
+    lines = ['# id sign verteces size peakVertex peakZ p']
+    for info in clusters:
+        peakVertex = info['peakVertex']
+        if verteces is not None:
+            peakVertex = verteces[peakVertex]
+        lines.append('%d %+d %d %.4f %d %.4f %.6f'
+                     % (info['id'], info['sign'], info['numberVerteces'],
+                        info['size'], peakVertex, info['peakZ'],
+                        info['p']))
+    table = '\n'.join(lines) + '\n'
+
+    return table
+
+
+#===============================================================================
+#--------------------------------------------------------------------------- GLM
+#===============================================================================
+
+def fsgdDesign(fsgd, modelType='dods', demean=None):
+    '''
+    Builds the design matrix of a loaded FSGD file the way mri_glmfit does.
+    Every class gets its own intercept. With 'dods' (different offset,
+    different slope) every variable gets one slope per class, with 'doss'
+    (different offset, same slope) one slope shared by all classes. The
+    columns are the class intercepts followed by the slopes of every
+    variable.
+
+    Like mri_glmfit, the variables are demeaned over all subjects first, so
+    the intercepts are the class means at the mean of the variables. This
+    follows the DeMeanFlag of the FSGD file (on if there is none), set
+    demean to override it.
+
+    returns the (#subjects, #regressors) design matrix and the names of the
+    regressors
+    '''
+    modelType = modelType.lower()
+    if not modelType in ['dods', 'doss']:
+        message = ('The model type %s is not implemented. Choose dods or doss'
+                   % (modelType))
+        raise Exception(message)
+    classes = fsgd['classes']
+    subjectClasses = np.array(fsgd['subjectClasses'])
+    values = np.asarray(fsgd['values'], dtype=float)
+    if demean is None:
+        demean = fsgd.get('demean', True)
+    if demean and len(values) > 0:
+        values = values - values.mean(axis=0)
+
+    membership = np.array([subjectClasses == className
+                           for className in classes], dtype=float).T
+    emptyClasses = [className for className, count
+                    in zip(classes, membership.sum(axis=0)) if count == 0]
+    if emptyClasses:
+        message = ('The classes %s have no subjects, the design would be '
+                   'singular' % (', '.join(emptyClasses)))
+        raise Exception(message)
+    columns = [membership]
+    names = list(classes)
+    for variable, name in enumerate(fsgd['variables']):
+        if modelType == 'dods':
+            columns.append(membership * values[:, [variable]])
+            names.extend(['%s.%s' % (name, className)
+                          for className in classes])
+        else:
+            columns.append(values[:, [variable]])
+            names.append(name)
+    design = np.hstack(columns)
+
+    return design, names
+
+
+def subsetFsgd(fsgd, subjects):
+    '''
+    Returns a copy of a loaded FSGD file with only the given subjects, in
+    their order. Build the design from this when not all subjects have data,
+    so the variables are demeaned over the subjects that are fitted
+    '''
+    rows = [fsgd['subjects'].index(subject) for subject in subjects]
+    subset = dict(fsgd)
+    subset['subjects'] = list(subjects)
+    subset['subjectClasses'] = [fsgd['subjectClasses'][row] for row in rows]
+    subset['values'] = np.asarray(fsgd['values'], dtype=float)[rows]
+
+    return subset
+
+
+def fitGlm(data, design):
+    '''
+    Fits the design (#subjects, #regressors) to every column of data
+    (#subjects, #verteces) with one least squares solve. The columns can
+    come from any number of radii and hemispheres, as long as they share
+    the subjects.
+
+    returns the betas (#regressors, #verteces), the residual variance of
+    every vertex and the degrees of freedom
+    '''
+    data = np.asarray(data, dtype=float)
+    design = np.asarray(design, dtype=float)
+    betas, residuals, rank, singular = np.linalg.lstsq(design, data,
+                                                       rcond=None)
+    df = design.shape[0] - rank
+    if df < 1:
+        message = ('The design has %d regressors of rank %d for %d subjects,'
+                   ' there are no degrees of freedom left'
+                   % (design.shape[1], rank, design.shape[0]))
+        raise Exception(message)
+    residualSquares = np.sum(np.square(data - design.dot(betas)), axis=0)
+    residualVariance = residualSquares / df
+
+    return betas, residualVariance, df
+
+
+def glmContrast(betas, residualVariance, df, design, contrast):
+    '''
+    Tests a contrast matrix (#rows, #regressors) on the fitted GLM. A
+    contrast with one row is a t-test, more rows make an F-test.
+
+    returns a dictionary with
+        - 'gamma': the contrast values (#rows, #verteces)
+        - 't' or 'F': the test statistic of every vertex
+        - 'sig': the -log10(p) of every vertex, signed by gamma for t-tests
+    '''
+    contrast = np.atleast_2d(np.asarray(contrast, dtype=float))
+    if contrast.shape[1] != design.shape[1]:
+        message = ('The contrast has %d columns but the design has %d'
+                   ' regressors' % (contrast.shape[1], design.shape[1]))
+        raise Exception(message)
+    designInverse = np.linalg.pinv(np.dot(design.T, design))
+    contrastVariance = contrast.dot(designInverse).dot(contrast.T)
+    gamma = contrast.dot(betas)
+    results = {'gamma': gamma}
+    # keeps the sig values finite
+    smallest = np.finfo(float).tiny
+
+    if contrast.shape[0] == 1:
+        standardError = np.sqrt(contrastVariance[0, 0] * residualVariance)
+        tValues = np.zeros(gamma.shape[1])
+        np.divide(gamma[0], standardError, out=tValues,
+                  where=standardError > 0)
+        pValues = 2 * st.t.sf(np.abs(tValues), df)
+        results['t'] = tValues
+        results['sig'] = np.sign(tValues) * -np.log10(np.maximum(pValues,
+                                                                 smallest))
+    else:
+        numberRows = contrast.shape[0]
+        middle = np.linalg.pinv(contrastVariance)
+        quadratic = np.sum(gamma * middle.dot(gamma), axis=0)
+        fValues = np.zeros(gamma.shape[1])
+        np.divide(quadratic, numberRows * residualVariance, out=fValues,
+                  where=residualVariance > 0)
+        pValues = st.f.sf(fValues, numberRows, df)
+        results['F'] = fValues
+        results['sig'] = -np.log10(np.maximum(pValues, smallest))
+
+    return results
+
+
+#===============================================================================
+#--------------------------------------------------------------------- Bootstrap
+#===============================================================================
+
+def bootstrapIndices(numberSubjects, numberResamples, randomState=None):
+    '''
+    Returns a (#resamples, #subjects) matrix of subject indices drawn with
+    replacement, one row per bootstrap resample
+    '''
+    if randomState is None:
+        randomState = np.random.RandomState()
+    indices = randomState.randint(0, numberSubjects,
+                                  size=(numberResamples, numberSubjects))
+
+    return indices
+
+
+def resampleCounts(indices, numberSubjects):
+    '''
+    Turns a matrix of resampled subject indices into a matrix of how often
+    every subject was drawn in every resample (#resamples, #subjects)
+    '''
+    numberResamples = indices.shape[0]
+    offsets = numberSubjects * np.arange(numberResamples)[:, np.newaxis]
+    counts = np.bincount((indices + offsets).ravel(),
+                         minlength=numberResamples * numberSubjects)
+
+    return counts.reshape(numberResamples, numberSubjects)
+
+
+def bootstrapMeans(data, numberResamples=10000, chunkSize=1000, seed=None):
+    '''
+    Returns the means of data (#subjects, #columns) over numberResamples
+    bootstrap resamples of the subjects as a (#resamples, #columns) array.
+    Every chunk of resamples is one matrix product of the resample counts
+    with the data, so all columns are done at once.
+    '''
+    data = np.asarray(data, dtype=float)
+    numberSubjects = data.shape[0]
+    randomState = np.random.RandomState(seed)
+    means = np.zeros((numberResamples, data.shape[1]))
+    done = 0
+    while done < numberResamples:
+        number = min(chunkSize, numberResamples - done)
+        indices = bootstrapIndices(numberSubjects, number, randomState)
+        counts = resampleCounts(indices, numberSubjects)
+        means[done:done + number] = counts.dot(data) / float(numberSubjects)
+        done += number
+
+    return means
+
+
+def bootstrapSummary(data, confidence=0.95, numberResamples=10000,
+                     chunkSize=1000, seed=None):
+    '''
+    Summarizes every column of data (#subjects, #columns) across subjects.
+    Returns a dictionary with the 'mean', the 'sd' and the 'lower' and
+    'upper' bounds of the percentile bootstrap confidence interval of the
+    mean of every column
+    '''
+    data = np.asarray(data, dtype=float)
+    means = bootstrapMeans(data, numberResamples, chunkSize, seed)
+    alpha = (1 - confidence) / 2.0
+    lower, upper = np.percentile(means, [100 * alpha, 100 * (1 - alpha)],
+                                 axis=0)
+    ddof = 1
+    if data.shape[0] < 2:
+        ddof = 0
+    summary = {'mean': data.mean(axis=0),
+               'sd': data.std(axis=0, ddof=ddof),
+               'lower': lower,
+               'upper': upper}
+
+    return summary
@@ -11,8 +11,8 @@ such as:
 
 '''
 import numpy as np
-import networkx as nx
 from surfer import Brain
+from scipy.sparse import csgraph as csg
 
 
 def drawROI(surface, source, radius, graph, paintDistance=False):
@@ -20,21 +20,21 @@ def drawROI(surface, source, radius, graph, paintDistance=False):
     Paint a ROI on the surface. Radius refers to radius in weighted or
     unweighted surfaces.
 
-    Expects a graph, a source that is member of the graph and a radius
+    Expects a sparse adjacency graph (as returned by procops.buildGraph), a
+    source that is member of the graph and a radius
     '''
-    neighbourDict = nx.single_source_dijkstra_path_length(graph,
-                                                          source,
-                                                          radius)
+    distances = csg.dijkstra(graph, directed=False, indices=int(source),
+                             limit=radius)
+    nodes = np.isfinite(distances)
 
     # prepare roi vector
     numberVertices = len(surface[0])
     roiVector = np.zeros(numberVertices)
 
-    for node in neighbourDict.keys():
-        if paintDistance:
-            roiVector[node] = neighbourDict[node]
-        else:
-            roiVector[node] = 1
+    if paintDistance:
+        roiVector[nodes] = distances[nodes]
+    else:
+        roiVector[nodes] = 1
 
     return roiVector
 
@@ -16,12 +16,11 @@ Things I would like to do with this code:
 '''
 import os
 import sys
-import shutil
+import time
 import subprocess
 import numpy as np
 import configure as cf
 import surfaceProcessing as sp
-from nibabel import freesurfer as nfs
 
 
 def loadSubjectList():
@@ -113,6 +112,155 @@ def makeGradient():
     print('Written condor file at %s' % (condorOut))
 
 
+class TemplateContext(object):
+    '''
+    Holds everything about the template of one hemisphere that does not
+    depend on the subject: the loaded surface, the cortex mask, the truncated
+    graph, the neighbourhoods for all radii and the parcels of the template
+    annotation if label processing is switched on.
+
+    Create it once per hemisphere and hand it to scoreSubjects for every
+    batch of subjects. The time spent setting it up is kept in setupTime.
+    '''
+    def __init__(self, hemi, radii):
+        startTime = time.time()
+        self.hemi = hemi
+        self.radii = radii
+        # Load the template, we only need it once
+        self.surfacePath = (cf.templatePath % (hemi))
+        self.surface = sp.fileops.loadSurface(self.surfacePath)
+        self.numberVerteces = len(self.surface[0])
+        self.maskPath = (cf.maskTemp % (hemi))
+        self.keepVerteces = sp.fileops.loadVector(self.maskPath,
+                                                  drop=2).astype(int)
+        self._graph = None
+        # The parcels are read once, the label averages of all subjects and
+        # radii are computed from the parcel vector
+        self.parcelIds = None
+        self.parcelNames = None
+        if cf.doLabel:
+            annotPath = (cf.annotTemp % (hemi))
+            parcels = sp.fileops.loadParcels(annotPath)
+            self.parcelIds, self.parcelNames = parcels
+
+        # The spin null model rotates the maps on the sphere of the template
+        self.sphereCoords = None
+        if cf.nullModel == 'spin':
+            sphere = sp.fileops.loadSurface(cf.sphereTemp % (hemi))
+            self.sphereCoords = np.asarray(sphere[0])
+
+        # Get the neighbourhoods for the largest radius in one go, the
+        # smaller radii are a subset of them. When the parcels are scored
+        # directly, there is one window per parcel instead of one per vertex
+        self.parcelScoring = cf.doLabel and cf.labelMode != 'average'
+        if self.parcelScoring:
+            maxIndex = self.loadParcelWindows(max(radii))
+        else:
+            maxIndex = self.loadNeighbours(max(radii))
+        self.neighbours = {}
+        for radius in radii:
+            self.neighbours[radius] = maxIndex.atRadius(radius)
+
+        self.setupTime = time.time() - startTime
+        print('Set up the %s template in %.1f s' % (hemi, self.setupTime))
+
+    def graph(self):
+        '''
+        Returns the graph of the surface truncated to the cortex mask. It is
+        only built when it is needed
+        '''
+        if self._graph is None:
+            # Construct a graph to represent the surface
+            graph, numberVerteces = sp.procops.buildGraph(self.surface,
+                                                          weighted=True)
+            # Truncate the graph based on the mask
+            self._graph = sp.procops.keepNodes(graph, self.keepVerteces)
+
+        return self._graph
+
+    def loadNeighbours(self, radius):
+        '''
+        Returns the neighbourhoods of all cortex verteces for the given
+        radius. If a neighbourhood cache directory is configured, they are
+        opened from there or computed once and stored for later runs and
+        other jobs.
+
+        Only compute this for the largest radius you need, the smaller ones
+        are cut out of it with NeighbourIndex.atRadius
+        '''
+        cacheDir = cf.neighbourCacheDir
+        method = cf.geodesicMethod
+        workers = cf.neighbourWorkers
+        blockSize = cf.neighbourBlockSize
+        keepVerteces = self.keepVerteces
+        if not cacheDir:
+            neighbourIndex = sp.procops.buildNeighbors(self.graph(), radius,
+                                                       source=keepVerteces,
+                                                       method=method,
+                                                       surface=self.surface,
+                                                       workers=workers,
+                                                       blockSize=blockSize)
+            return neighbourIndex
+
+        key = sp.fileops.neighbourCacheKey(self.surface, keepVerteces, radius,
+                                           method=method)
+        neighbourIndex = sp.fileops.loadCachedNeighbours(cacheDir, key)
+        if neighbourIndex is None:
+            # Entries of an older version of this template are not valid
+            templateKey = sp.fileops.templateCacheKey(self.surface)
+            sp.fileops.invalidateNeighbourCache(cacheDir,
+                                                templatePath=self.surfacePath,
+                                                templateKey=templateKey)
+            neighbourIndex = sp.procops.buildNeighbors(self.graph(), radius,
+                                                       source=keepVerteces,
+                                                       method=method,
+                                                       surface=self.surface,
+                                                       workers=workers,
+                                                       blockSize=blockSize)
+            meta = {'templatePath': self.surfacePath,
+                    'templateKey': templateKey}
+            sp.fileops.storeCachedNeighbours(cacheDir, key, neighbourIndex,
+                                             meta=meta)
+            sp.fileops.evictNeighbourCache(cacheDir, cf.neighbourCacheSize)
+
+        return neighbourIndex
+
+    def nullDraw(self):
+        '''
+        Returns a new function that draws surrogates for the configured null
+        model. It always starts from the same seed, so all subjects and
+        radii are tested against the same surrogates
+        '''
+        if cf.nullModel == 'spin':
+            drawNull = sp.procops.spinNull(self.sphereCoords,
+                                           self.keepVerteces, cf.nullSeed)
+        else:
+            drawNull = sp.procops.shuffleNull(self.numberVerteces,
+                                              self.keepVerteces, cf.nullSeed)
+
+        return drawNull
+
+    def loadParcelWindows(self, radius):
+        '''
+        Returns a NeighbourIndex with one window per parcel. With
+        labelMode='parcel' a window holds the cortex verteces of the parcel,
+        with labelMode='dilated' also those within the radius around it
+        '''
+        numberParcels = len(self.parcelNames)
+        if cf.labelMode == 'dilated':
+            parcelIndex = sp.procops.buildParcelIndex(self.parcelIds,
+                                                      numberParcels,
+                                                      self.keepVerteces,
+                                                      graph=self.graph(),
+                                                      radius=radius)
+        else:
+            parcelIndex = sp.procops.buildParcelIndex(self.parcelIds,
+                                                      numberParcels,
+                                                      self.keepVerteces)
+
+        return parcelIndex
+
+
 def doSurfaceCorrelation():
     '''
     This method correlates two surfaces with one another within a certain
@@ -122,162 +270,500 @@ def doSurfaceCorrelation():
     The mask should be an overlay of zeroes and ones.
 
     Notes:
-        To run the whole thing on individual labels, we need to specify the
-        path to the label directory that contains the labels for the correct
-        hemisphere and template. Then, we can cut out the appropriate part and
-        store it in the file.
+        To run the whole thing on individual labels, set doLabel and point
+        annotTemp to the annotation of the template. Every vertex of the
+        output then holds the value of its parcel. With labelMode='average'
+        this is the average of the vertex-wise map, with 'parcel' or
+        'dilated' the score is computed on the pooled verteces of the parcel
+        directly and no vertex-wise neighbourhoods are needed.
 
     Testing:
     - can I load the files that I have transformed with nibabel as morph files?
     '''
     # Stuff that should be defined dynamically elsewhere
-    gradientTemp = cf.gradientTemp
-    overlayTemp = cf.overlayTemp
-    maskTemp = cf.maskTemp
-    surfaceTemp = cf.templatePath
-    inputDir = cf.correlationInputDir
     radii = cf.radii
     hemispheres = cf.hemipsheres
-    score = cf.score
-    tempDir = cf.tempDir
-    outDir = cf.correlationOutDir
-    outName = cf.correlationOutName
-    useAbsVals = cf.useAbsVals
-    labelPath = cf.labelPath
-    doLabel = cf.doLabel
 
-    subjectList = loadSubjectList()
+    if not cf.score in sp.procops.scoreRegistry:
+        message = ('The score %s is not implemented. Choose one of:\n%s'
+                   % (cf.score, sp.procops.describeScores()))
+        raise Exception(message)
+    if cf.doLabel and not cf.labelMode in ['average', 'parcel', 'dilated']:
+        message = ('The label mode %s is not implemented. Choose one of '
+                   'average, parcel or dilated' % (cf.labelMode))
+        raise Exception(message)
+    if cf.nullModel and not cf.nullModel in ['spin', 'shuffle']:
+        message = ('The null model %s is not implemented. Choose spin or '
+                   'shuffle' % (cf.nullModel))
+        raise Exception(message)
 
-    if doLabel:
-        # First, unpack the labels
-        findLabels()
-        # Load the label list
-        f = open(labelPath, 'rb')
-        labels = f.readlines()
-        f.close()
+    subjectList = loadSubjectList()
 
-    labelList = []
-    for line in labels:
-        label = line.strip()
-    labelList.append(label)
+    manifest = sp.fileops.loadManifest(cf.manifestPath)
 
     for hemi in hemispheres:
-        if hemi == 'lh':
-            altHemi = 'L'
-        elif hemi == 'rh':
-            altHemi = 'R'
-        else:
+        if not hemi in ['lh', 'rh']:
             message = ('Your specified hemisphere (%s) is invalid. Ending' % (hemi))
             raise Exception(message)
-        # Load the template, we only need it once
-        surfacePath = (surfaceTemp % (hemi))
-        surface = sp.fileops.loadSurface(surfacePath)
 
+        # The maps of all subjects go into the cohort stores of the
+        # hemisphere, one for the maps and one for their p-values
+        suffixes = outputSuffixes()
+        stores = {}
+        if cf.cohortDir:
+            for suffix in suffixes:
+                quantity = storeQuantity(suffix)
+                stores[suffix] = sp.fileops.loadCohortStore(cf.cohortDir,
+                                                            hemi, quantity)
+
+        # Only run the subjects that are missing or out of date
+        templateInputs = templateHashes(hemi)
+        runList = []
         for subID in subjectList:
-            subDir = os.path.join(inputDir, subID)
-            subOutDir = os.path.join(outDir, subID)
-
-            if not os.path.isdir(subOutDir):
-                os.makedirs(subOutDir)
-
-            # Generate the paths that we want to look at
-            gradientName = (gradientTemp % (subID, altHemi))
-            overlayName = (overlayTemp % (subID, hemi))
-            overlayName = ('%s.mgh' % overlayName)
-            overlayPath = os.path.join(subDir, overlayName)
-
-            maskPath = (maskTemp % (hemi))
-
-            # Check if we have the overlay
-            if not os.path.isfile(overlayPath):
-                message = ('Could not find overlay at %s.\nQuitting!' % (overlayPath))
-                raise Exception(message)
-
-            # Check if we already have the gradient in mgh format
-            gradientMgh = ('%s.mgh' % gradientName)
-            gradientMghOutPath = os.path.join(subDir, gradientName)
-            gradientMghPath = os.path.join(subDir, gradientMgh)
-            if not os.path.isfile(gradientMghPath):
-                # Get the oneD file
-                gradientOneD = ('%s.1D' % (gradientName))
-                gradientOneDPath = os.path.join(subDir, gradientOneD)
-                if not os.path.isfile(gradientOneDPath):
-                    message = ('Could not find either 1D or mgh gradient in %s\n(%s / %s)' % (subDir, gradientOneDPath, gradientMghPath))
-                    raise Exception(message)
-                # Generate the mgh file
-                tempOneD = sp.fileops.loadVector(gradientOneDPath)
-                tempOutName = ('%s_temp' % gradientName)
-                tempOut = os.path.join(tempDir, tempOutName)
-                outStr = sp.fileops.writeVector(surface, tempOneD, mode='ascii')
-                savePath = sp.fileops.saveTxt(tempOut, outStr, 'asc',
-                                              hemi=hemi)
-                sp.fileops.convertMorphAsciiMgh(savePath, surfacePath,
-                                                outType='mgh',
-                                                outPath=gradientMghOutPath)
-
-            # Get the files loaded
-            gradient = sp.fileops.loadScalar(gradientMghPath)
-            overlay = sp.fileops.loadScalar(overlayPath)
-            if useAbsVals:
-                overlay = np.abs(overlay)
-            keepVerteces = sp.fileops.loadVector(maskPath, drop=2)
+            for radius in radii:
+                record = jobRecord(hemi, subID, radius, templateInputs)
+                if not isJobFresh(manifest, hemi, subID, radius, record,
+                                  stores):
+                    runList.append(subID)
+                    break
+        print('%s: %d of %d subjects need to be run'
+              % (hemi, len(runList), len(subjectList)))
+        if not runList:
+            continue
+
+        # Everything that depends only on the template is done once here
+        context = TemplateContext(hemi, radii)
+        if cf.cohortDir:
+            for suffix in suffixes:
+                quantity = storeQuantity(suffix)
+                stores[suffix] = sp.fileops.openCohortStore(
+                    cf.cohortDir, hemi, quantity, subjectList, radii,
+                    context.numberVerteces)
+
+        # The subjects are scored in batches, so every neighbourhood is only
+        # gathered once per batch
+        batchSize = max(1, cf.subjectBatchSize)
+        subjectTimes = []
+        for start in range(0, len(runList), batchSize):
+            subjectBatch = runList[start:start + batchSize]
+            startTime = time.time()
+            scoreSubjects(context, subjectBatch, stores)
+            for store in stores.values():
+                store.flush()
+            batchTime = time.time() - startTime
+            subjectTimes.extend([batchTime / len(subjectBatch)]
+                                * len(subjectBatch))
+            print('Finished %d subjects on %s in %.1f s'
+                  % (len(subjectBatch), hemi, batchTime))
+
+            # Record the finished jobs right away, so an interrupted run can
+            # pick up from here
+            if cf.manifestPath:
+                records = {}
+                for subID in subjectBatch:
+                    for radius in radii:
+                        record = jobRecord(hemi, subID, radius,
+                                           templateInputs)
+                        records[jobKey(hemi, subID, radius)] = record
+                sp.fileops.updateManifest(cf.manifestPath, records)
+                manifest.update(records)
+
+        if subjectTimes:
+            print('%s: template setup %.1f s, %d subjects in %.1f s (%.1f s '
+                  'per subject)' % (hemi, context.setupTime, len(subjectTimes),
+                                    sum(subjectTimes), np.mean(subjectTimes)))
+
+
+def jobKey(hemi, subID, radius):
+    '''
+    Name of a job in the manifest
+    '''
+    return '%s %s %s' % (subID, hemi, str(radius))
 
-            # Construct a graph to represent the surface
-            graph, numberVerteces = sp.procops.buildGraph(surface,
-                                                          weighted=True)
-            # Truncate the graph based on the mask
-            truncGraph = sp.procops.keepNodes(graph, keepVerteces)
 
-            # For each radius, correlate the two values
-            for radius in radii:
-                # Generate the distance dictionary for the current radius
-                distanceDict = sp.procops.buildNeighbors(truncGraph, radius)
-                vertVec = sp.procops.slideRoiValues(numberVerteces, keepVerteces,
-                                                    distanceDict, gradient,
-                                                    morphVec2=overlay, score=score)
-                # Generate the output paths
-                tempName = (outName % (subID, radius, hemi))
-                saveName = (outName % (subID, radius, hemi))
-
-                if doLabel:
-                    # Get the label vector and take the average of the
-                    # correlation map
-                    #
-                    # make a storage vector for the label processing
-                    labelVec = np.zeros_like(vertVec)
-                    for label in labelList:
-                        # make label name
-                        labelName = os.path.basename(label)
-                        # read the label
-                        labVec = nfs.read_label(label)
-                        # use the indices to take a slice out of the overlay
-                        sliceVec = vertVec[labVec]
-                        # take the average of that slice
-                        avgSlice = np.mean(sliceVec)
-                        # and write it back into the appropriate verteces
-                        labelVec[labVec] = avgSlice
-
-                    # Adjust the names for the save files
-                    tempName = ('%s_label' % tempName)
-                    saveName = ('%s_label' % outName)
-
-                    outVec = labelVec
-                else:
-                    # If we are not using label computation, just write the
-                    # vertex-vise vector
-                    outVec = vertVec
-
-                # Generate the paths for the output
-                tempOut = os.path.join(tempDir, tempName)
-                saveOut = os.path.join(subOutDir, saveName)
-
-                # Generate the output files
-                outStr = sp.fileops.writeVector(surface, outVec, mode='ascii')
-                savePath = sp.fileops.saveTxt(tempOut, outStr, 'asc',
-                                              hemi=hemi)
-                sp.fileops.convertMorphAsciiMgh(savePath, surfacePath,
-                                                outType='mgh',
-                                                outPath=saveOut)
+def templateHashes(hemi):
+    '''
+    Hashes the inputs that are shared by all subjects of a hemisphere: the
+    template surface, the cortex mask and the annotation with the parcels
+    '''
+    inputs = {'template': sp.fileops.hashFile(cf.templatePath % (hemi)),
+              'mask': sp.fileops.hashFile(cf.maskTemp % (hemi)),
+              'labels': None}
+    if cf.doLabel:
+        inputs['labels'] = sp.fileops.hashFile(cf.annotTemp % (hemi))
+
+    return inputs
+
+
+def jobRecord(hemi, subID, radius, templateInputs):
+    '''
+    Describes one job (subject, hemisphere, radius) by the hashes of its
+    inputs, the parameters that change its result and its output path
+    '''
+    paths = subjectPaths(hemi, subID)
+    inputs = dict(templateInputs)
+    # hash the file the gradient will be loaded from
+    inputs['gradient'] = sp.fileops.hashFile(gradientSource(paths))
+    inputs['overlay'] = sp.fileops.hashFile(paths['overlay'])
+    if sp.procops.scoreRegistry[cf.score]['covariate']:
+        inputs['covariate'] = sp.fileops.hashFile(paths['covariate'])
+
+    params = {'score': cf.score,
+              'radius': radius,
+              'useAbsVals': cf.useAbsVals,
+              'doLabel': cf.doLabel,
+              'labelMode': cf.labelMode,
+              'nullModel': cf.nullModel,
+              'numberPermutations': cf.numberPermutations,
+              'nullSeed': cf.nullSeed,
+              'geodesicMethod': cf.geodesicMethod}
+    if cf.cohortDir and not cf.exportSubjectMaps:
+        output = sp.fileops.cohortStorePaths(cf.cohortDir, hemi,
+                                             storeQuantity())['data']
+    else:
+        output = '%s.mgh' % subjectOutPath(hemi, subID, radius)
+    record = {'inputs': inputs,
+              'params': params,
+              'output': output}
+
+    return record
+
+
+def isJobFresh(manifest, hemi, subID, radius, record, stores=None):
+    '''
+    A job is up to date if the manifest has the same record for it and all
+    of its outputs (the map and, with a null model, the p-values) still
+    exist. With cohort stores (stores holds them by output suffix), its maps
+    also have to be in the stores
+    '''
+    if stores is None:
+        stores = {}
+    if not cf.manifestPath:
+        return False
+    oldRecord = manifest.get(jobKey(hemi, subID, radius))
+    if oldRecord is None:
+        return False
+    for field in ['inputs', 'params', 'output']:
+        if oldRecord.get(field) != record[field]:
+            return False
+    if cf.cohortDir:
+        for suffix in outputSuffixes():
+            store = stores.get(suffix)
+            if store is None or not store.isWritten(subID, radius):
+                return False
+    if not cf.cohortDir or cf.exportSubjectMaps:
+        for suffix in outputSuffixes():
+            outPath = subjectOutPath(hemi, subID, radius, suffix=suffix)
+            if not os.path.isfile('%s.mgh' % (outPath)):
+                return False
+
+    return os.path.isfile(record['output'])
+
+
+def outputSuffixes():
+    '''
+    Returns the suffixes of the outputs of every job: '' for the maps and
+    '_pval' for their p-values if a null model is set
+    '''
+    suffixes = ['']
+    if cf.nullModel:
+        suffixes.append('_pval')
+
+    return suffixes
+
+
+def subjectPaths(hemi, subID):
+    '''
+    Returns the paths to the input files of one subject and hemisphere
+    '''
+    subDir = os.path.join(cf.correlationInputDir, subID)
+    if hemi == 'lh':
+        altHemi = 'L'
+    else:
+        altHemi = 'R'
+
+    gradientName = (cf.gradientTemp % (subID, altHemi))
+    overlayName = (cf.overlayTemp % (subID, hemi))
+    covariateName = (cf.covariateTemp % (subID, hemi))
+    paths = {'subDir': subDir,
+             'gradientBase': os.path.join(subDir, gradientName),
+             'gradientMgh': os.path.join(subDir, '%s.mgh' % gradientName),
+             'gradientOneD': os.path.join(subDir, '%s.1D' % gradientName),
+             'overlay': os.path.join(subDir, '%s.mgh' % overlayName),
+             'covariate': os.path.join(subDir, '%s.mgh' % covariateName)}
+
+    return paths
+
+
+def gradientSource(paths):
+    '''
+    Returns the path of the file the gradient of a subject is loaded from:
+    the mgh file, unless there is none yet or the 1D file is newer. Then the
+    mgh file is made from the 1D file first and the 1D file is returned
+    '''
+    mghPath = paths['gradientMgh']
+    oneDPath = paths['gradientOneD']
+    if os.path.isfile(oneDPath):
+        if (not os.path.isfile(mghPath)
+                or os.path.getmtime(oneDPath) > os.path.getmtime(mghPath)):
+            return oneDPath
+
+    return mghPath
+
+
+def subjectOutPath(hemi, subID, radius, suffix=''):
+    '''
+    Returns the path of the output file of one subject, hemisphere and
+    radius, without the .mgh extension. The suffix is appended to the name,
+    for example for the p-values
+    '''
+    saveName = (cf.correlationOutName % (subID, radius, hemi))
+    if cf.doLabel:
+        saveName = ('%s_label' % saveName)
+    saveName = ('%s%s' % (saveName, suffix))
+    saveOut = os.path.join(cf.correlationOutDir, subID, saveName)
+
+    return saveOut
+
+
+def storeQuantity(suffix=''):
+    '''
+    Returns the name of the surface computation outputs in the cohort store.
+    Like the output files, it is marked for label processing and gets the
+    suffix appended (e.g. correlation_label_pval)
+    '''
+    quantity = 'correlation'
+    if cf.doLabel:
+        quantity = ('%s_label' % quantity)
+
+    return '%s%s' % (quantity, suffix)
+
+
+def loadSubjectMaps(context, subID):
+    '''
+    Loads the gradient and the overlay of one subject on the hemisphere of
+    the TemplateContext. If the gradient is only available as a 1D file, it
+    is converted to mgh first. If the score needs a covariate, it is loaded
+    as well, otherwise the covariate is None.
+    '''
+    # Stuff that should be defined dynamically elsewhere
+    useAbsVals = cf.useAbsVals
+
+    hemi = context.hemi
+
+    # Generate the paths that we want to look at
+    paths = subjectPaths(hemi, subID)
+    subDir = paths['subDir']
+    overlayPath = paths['overlay']
+
+    # Check if we have the overlay
+    if not os.path.isfile(overlayPath):
+        message = ('Could not find overlay at %s.\nQuitting!' % (overlayPath))
+        raise Exception(message)
+
+    # Check if we already have the gradient in mgh format, and that it is
+    # not older than the 1D file
+    gradientMghPath = paths['gradientMgh']
+    gradientOneDPath = paths['gradientOneD']
+    if gradientSource(paths) != gradientMghPath:
+        if not os.path.isfile(gradientOneDPath):
+            message = ('Could not find either 1D or mgh gradient in %s\n(%s / %s)' % (subDir, gradientOneDPath, gradientMghPath))
+            raise Exception(message)
+        # Generate the mgh file
+        oneD = sp.fileops.loadVector.uncached(gradientOneDPath)
+        sp.fileops.saveMgh(gradientMghPath, oneD)
+
+    # Get the files loaded. They are only read once per subject, so they
+    # don't go through the cache that is kept for the template files
+    gradient = sp.fileops.loadScalar.uncached(gradientMghPath)
+    overlay = sp.fileops.loadScalar.uncached(overlayPath)
+    if useAbsVals:
+        overlay = np.abs(overlay)
+
+    covariate = None
+    if sp.procops.scoreRegistry[cf.score]['covariate']:
+        covariatePath = paths['covariate']
+        if not os.path.isfile(covariatePath):
+            message = ('Could not find covariate at %s.\nQuitting!'
+                       % (covariatePath))
+            raise Exception(message)
+        covariate = sp.fileops.loadScalar.uncached(covariatePath)
+
+    return gradient, overlay, covariate
+
+
+def scoreSubjects(context, subjectBatch, stores=None):
+    '''
+    Does the surface correlation of a batch of subjects on the hemisphere of
+    the TemplateContext for all radii and writes out the results. stores
+    holds the cohort stores for the output suffixes ('' and '_pval'), if
+    there are any.
+
+    The gradients and overlays of all subjects in the batch are stacked into
+    (#subjects, #verteces) matrices and scored in one go per radius.
+    '''
+    if stores is None:
+        stores = {}
+    gradients = []
+    overlays = []
+    covariates = []
+    for subID in subjectBatch:
+        gradient, overlay, covariate = loadSubjectMaps(context, subID)
+        gradients.append(gradient)
+        overlays.append(overlay)
+        covariates.append(covariate)
+    gradients = np.vstack(gradients)
+    overlays = np.vstack(overlays)
+    if covariates[0] is None:
+        covariates = None
+    else:
+        covariates = np.vstack(covariates)
+
+    # For each radius, correlate the two values
+    for radius in context.radii:
+        vertMat, pMat = scoreRadius(context, radius, gradients, overlays,
+                                    covariates)
+        for row, subID in enumerate(subjectBatch):
+            writeSubjectMap(context, subID, radius, vertMat[row],
+                            store=stores.get(''))
+            if pMat is not None:
+                writeSubjectMap(context, subID, radius, pMat[row],
+                                suffix='_pval', store=stores.get('_pval'))
+
+
+def scoreRadius(context, radius, gradients, overlays, covariates):
+    '''
+    Scores a batch of subjects on one radius. Returns the maps and, if a
+    null model is configured, the empirical p-values as (#subjects,
+    #verteces) matrices. With label processing, every vertex holds the
+    value of its parcel.
+    '''
+    score = cf.score
+    neighbourIndex = context.neighbours[radius]
+    parcelIds = context.parcelIds
+    numberParcels = None
+    if cf.doLabel:
+        numberParcels = len(context.parcelNames)
+    if context.parcelScoring:
+        # One score per parcel, written back to all of its verteces later
+        numberVerteces = numberParcels
+        verteces = np.arange(numberParcels)
+        parcelIds = None
+    else:
+        numberVerteces = context.numberVerteces
+        verteces = context.keepVerteces
+
+    pMat = None
+    if not cf.nullModel:
+        scoreMat = sp.procops.slideRoiValues(numberVerteces, verteces,
+                                             neighbourIndex, gradients,
+                                             morphVec2=overlays, score=score,
+                                             covariate=covariates)
+    else:
+        # The chunk is shared by all subjects of the batch
+        chunkSize = max(1, cf.permutationChunk // len(gradients))
+        drawNull = context.nullDraw()
+        pValues = sp.procops.permutationPValues(numberVerteces, verteces,
+                                                neighbourIndex, gradients,
+                                                overlays, score, covariates,
+                                                drawNull,
+                                                cf.numberPermutations,
+                                                chunkSize, parcelIds,
+                                                numberParcels)
+        scoreMat, pMat, parcelPMat = pValues
+        if parcelIds is not None:
+            pMat = sp.procops.spreadParcels(parcelPMat, parcelIds, fill=1)
+
+    if context.parcelScoring:
+        scoreMat = sp.procops.spreadParcels(scoreMat, context.parcelIds)
+        if pMat is not None:
+            pMat = sp.procops.spreadParcels(pMat, context.parcelIds,
+                                            fill=1)
+    elif cf.doLabel:
+        # Average within the parcels for the whole batch at once
+        scoreMat = sp.procops.parcelMap(scoreMat, parcelIds, numberParcels)
+
+    return scoreMat, pMat
+
+
+def writeSubjectMap(context, subID, radius, vertVec, suffix='', store=None):
+    '''
+    Writes the correlation map of one subject and radius into the cohort
+    store and, if there is no store or exportSubjectMaps is set, to the
+    subject's output directory. With label processing, vertVec already holds
+    the averages of the parcels. The suffix is appended to the output name.
+    '''
+    hemi = context.hemi
+    if store is not None:
+        store.write(subID, radius, vertVec)
+        if not cf.exportSubjectMaps:
+            return
+
+    # Generate the output paths
+    saveOut = subjectOutPath(hemi, subID, radius, suffix=suffix)
+    subOutDir = os.path.dirname(saveOut)
+    if not os.path.isdir(subOutDir):
+        os.makedirs(subOutDir)
+
+    sp.fileops.saveMgh('%s.mgh' % (saveOut), vertVec)
+
+
+def findSubjectMaps(subjectList, radius, hemi):
+    '''
+    Looks for the surface computation outputs of the subjects for one radius
+    and hemisphere. Returns the subjects that have one and the paths to
+    their files
+    '''
+    searchDir = cf.correlationOutDir
+    searchFile = cf.correlationOutName
+    doLabel = cf.doLabel
+
+    fileList = []
+    useList = []
+    for subject in subjectList:
+        # first find the appropriate file#
+        fileName = (searchFile % (subject, radius, hemi))
+        if doLabel:
+            # append the '_label' part to the file name
+            fileName = ('%s_label' % (fileName))
+        fileName = ('%s.mgh' % (fileName))
+        subSearchDir = os.path.join(searchDir, subject)
+        # subSearchDir = searchDir
+        fileDir = sp.fileops.findFileAtPath(fileName, subSearchDir)
+        if not fileDir:
+            print('Did not find subject %s %s rad %d' % (subject, hemi,
+                                                         radius))
+            # Leave this subject
+            continue
+        useList.append(subject)
+        fileList.append(fileDir)
+
+    return useList, fileList
+
+
+def loadSubjectStack(subjectList, radius, hemi):
+    '''
+    Loads the surface computation outputs of the subjects for one radius and
+    hemisphere as a (#subjects, #verteces) matrix. They come from the cohort
+    store if there is one (as a view into it where possible), otherwise from
+    the mgh files of the subjects. Returns the subjects that have an output
+    and the matrix
+    '''
+    store = sp.fileops.loadCohortStore(cf.cohortDir, hemi, storeQuantity())
+    if store is None:
+        useList, fileList = findSubjectMaps(subjectList, radius, hemi)
+        maps = None
+        if fileList:
+            maps = sp.fileops.loadStack(fileList, cf.stackThreads)
+        return useList, maps
+
+    useList, maps = store.stack(subjectList, radius)
+    for subject in subjectList:
+        if not subject in useList:
+            print('Did not find subject %s %s rad %d in the cohort store'
+                  % (subject, hemi, radius))
+
+    return useList, maps
 
 
 def makeGlm():
@@ -293,11 +779,6 @@ def makeGlm():
     glmContrastTemp = cf.glmContrastName
     glmFsgdTemp = cf.glmDesigMatName
 
-    labelPath = cf.labelPath
-    doLabel = cf.doLabel
-
-    searchDir = cf.correlationOutDir
-    searchFile = cf.correlationOutName
     condorFile = cf.glmCondorName
     condorDir = cf.condorDir
     vertexThresh = cf.vertexThresh
@@ -313,30 +794,18 @@ def makeGlm():
 
     for radius in radii:
         for hemi in ['lh', 'rh']:
-            fileList = []
-            useList = []
-            for subject in subjectList:
-                # first find the appropriate file#
-                fileName = (searchFile % (subject, radius, hemi))
-                if doLabel:
-                    # append the '_label' part to the file name
-                    fileName = ('%s_label' % (fileName))
-                fileName = ('%s.mgh' % (fileName))
-                subSearchDir = os.path.join(searchDir, subject)
-                # subSearchDir = searchDir
-                fileDir = sp.fileops.findFileAtPath(fileName, subSearchDir)
-                if not fileDir:
-                    print('Did not find subject %s %s rad %d' % (subject, hemi,
-                                                                 radius))
-                    # Leave this subject
-                    continue
-                useList.append(subject)
-                fileList.append(fileDir)
-
-            # Make the GLM stack
+            # Make the GLM stack, from the cohort store if there is one
             glmStackName = (glmStackTemp % (radius, hemi))
             glmOut = os.path.join(glmPrepDir, glmStackName)
-            glmOut = sp.fileops.stackFiles(fileList, glmOut)
+            store = sp.fileops.loadCohortStore(cf.cohortDir, hemi,
+                                               storeQuantity())
+            if store is not None:
+                useList, glmOut = store.saveStack(subjectList, radius, glmOut)
+            else:
+                useList, fileList = findSubjectMaps(subjectList, radius,
+                                                    hemi)
+                glmOut = sp.fileops.stackFiles(fileList, glmOut,
+                                               numberThreads=cf.stackThreads)
             # Make the contrast
             contrastBaseName = (glmContrastTemp % (radius, hemi))
             contrastName = ('%s.mtx' % (contrastBaseName))
@@ -353,7 +822,7 @@ def makeGlm():
             modelDir = os.path.join(glmOutDir, contrastBaseName)
             if not os.path.isdir(modelDir):
                 os.makedirs(modelDir)
-            shutil.copy2(glmOut, modelDir)
+            sp.fileops.linkFile(glmOut, modelDir)
             glmStr = sp.fileops.genGlm(False, [contrastOut], fsgdOut, hemi,
                                             glmOut, modelDir, 'dods',
                                             vertexThresh, clustThresh, posneg)
@@ -372,6 +841,267 @@ def makeGlm():
     print('Written condor file at %s' % (condorOut))
 
 
+def doGroupTest():
+    '''
+    This method tests the surface computation outputs across subjects
+    against a mean of 0 in this process, without mri_glmfit and condor.
+
+    For every radius and hemisphere, the subject maps are loaded as one
+    matrix, the t-values are computed for all verteces in the cortex mask
+    at once and the clusters are corrected with sign flip permutations of
+    the subjects. The results are written to the same directories as the
+    ones of makeGlm:
+        - t.mgh, z.mgh: the t-values and the matching z-values
+        - sig.mgh: the signed -log10(p) of the vertex p-values
+        - clusters.mgh: the number of every significant cluster
+        - clusterSig.mgh: the signed -log10(p) of the cluster p-values
+        - clusters.txt: a table of all clusters
+    '''
+    # Stuff to be supplied dynamically
+    glmOutDir = cf.glmOutDir
+    glmContrastTemp = cf.glmContrastName
+    vertexThresh = cf.vertexThresh
+    clustThresh = cf.clustThresh
+    posneg = cf.posneg
+    radii = cf.radii
+    hemispheres = cf.hemipsheres
+
+    subjectList = loadSubjectList()
+
+    for hemi in hemispheres:
+        # The template is the same for all radii
+        surfacePath = (cf.templatePath % (hemi))
+        surface = sp.fileops.loadSurface(surfacePath)
+        numberVerteces = len(surface[0])
+        keepVerteces = sp.fileops.loadVector(cf.maskTemp % (hemi),
+                                             drop=2).astype(int)
+        adjacency = sp.statops.meshAdjacency(surface, keepVerteces)
+        areas = sp.statops.vertexAreas(surface)[keepVerteces]
+
+        for radius in radii:
+            useList, data = loadSubjectStack(subjectList, radius, hemi)
+            if len(useList) < 2:
+                print('Need at least 2 subjects for %s rad %d, skipping'
+                      % (hemi, radius))
+                continue
+
+            startTime = time.time()
+            results = sp.statops.clusterTest(data[:, keepVerteces],
+                                             adjacency, vertexThresh,
+                                             clustThresh, posneg,
+                                             cf.groupPermutations,
+                                             cf.groupChunk, areas,
+                                             cf.groupSeed)
+            print('Tested %d subjects on %s rad %d in %.1f s'
+                  % (len(useList), hemi, radius, time.time() - startTime))
+
+            modelDir = os.path.join(glmOutDir, glmContrastTemp % (radius,
+                                                                  hemi))
+            if not os.path.isdir(modelDir):
+                os.makedirs(modelDir)
+            outMaps = {'t': 't', 'z': 'z', 'sig': 'sig',
+                       'clusterIds': 'clusters', 'clusterSig': 'clusterSig'}
+            for key, outName in outMaps.items():
+                vertVec = sp.procops.mapBack(results[key], keepVerteces,
+                                             numberVerteces)
+                sp.fileops.saveMgh(os.path.join(modelDir,
+                                                '%s.mgh' % (outName)),
+                                   vertVec)
+            table = sp.statops.clusterTable(results['clusters'],
+                                           keepVerteces)
+            sp.fileops.saveTxt(os.path.join(modelDir, 'clusters'), table)
+
+
+def doGlm():
+    '''
+    This method fits a GLM to the surface computation outputs in this
+    process, without mri_glmfit and condor.
+
+    The design comes from the FSGD file in glmFsgdPath (with classes and
+    continuous variables, see statops.fsgdDesign) or, without one, is a
+    single group of all subjects. Subjects that have no map for a radius and
+    hemisphere are left out of it. All radii and hemispheres that have the
+    same subjects are fitted in one least squares solve.
+
+    The results are written to the same directories as the ones of makeGlm:
+        - beta.mgh: the betas, one frame per regressor
+        - rvar.mgh: the residual variance
+        - one directory per contrast (named like the contrast file) with
+          gamma.mgh (one frame per row of the contrast), t.mgh (or F.mgh
+          for contrasts with more than one row) and sig.mgh, the -log10(p)
+          of the test
+    Without contrast files, the first regressor is tested against 0 and
+    written to a directory named like the contrast of makeGlm.
+    '''
+    # Stuff to be supplied dynamically
+    glmOutDir = cf.glmOutDir
+    glmContrastTemp = cf.glmContrastName
+    radii = cf.radii
+    hemispheres = cf.hemipsheres
+
+    subjectList = loadSubjectList()
+    if cf.glmFsgdPath:
+        fsgd = sp.fileops.loadFsgd(cf.glmFsgdPath)
+    else:
+        numberSubjects = len(subjectList)
+        fsgd = {'title': 'Main',
+                'classes': ['Main'],
+                'variables': [],
+                'subjects': list(subjectList),
+                'subjectClasses': ['Main'] * numberSubjects,
+                'values': np.zeros((numberSubjects, 0))}
+    contrasts = []
+    for contrastPath in cf.glmContrastPaths:
+        contrasts.append((sp.tools.getBaseName(contrastPath),
+                          sp.fileops.loadContrast(contrastPath)))
+
+    # Collect the maps and group them by the subjects that have them
+    templates = {}
+    jobs = {}
+    for hemi in hemispheres:
+        surfacePath = (cf.templatePath % (hemi))
+        surface = sp.fileops.loadSurface(surfacePath)
+        keepVerteces = sp.fileops.loadVector(cf.maskTemp % (hemi),
+                                             drop=2).astype(int)
+        templates[hemi] = (surface, surfacePath, keepVerteces)
+        for radius in radii:
+            useList, maps = loadSubjectStack(fsgd['subjects'], radius,
+                                             hemi)
+            jobs.setdefault(tuple(useList), []).append((hemi, radius,
+                                                        maps))
+
+    for useList, jobList in jobs.items():
+        if not useList:
+            continue
+        # The design only holds the subjects that have maps, so the
+        # variables are demeaned over them
+        useFsgd = sp.statops.subsetFsgd(fsgd, useList)
+        useDesign, regressors = sp.statops.fsgdDesign(useFsgd,
+                                                      cf.glmModelType)
+        # One big matrix with the cortex verteces of all jobs side by side
+        blocks = []
+        for hemi, radius, maps in jobList:
+            keepVerteces = templates[hemi][2]
+            blocks.append(maps[:, keepVerteces])
+        data = np.hstack(blocks)
+        startTime = time.time()
+        betas, residualVariance, df = sp.statops.fitGlm(data, useDesign)
+        jobContrasts = contrasts
+        if not jobContrasts:
+            firstRegressor = np.zeros((1, useDesign.shape[1]))
+            firstRegressor[0, 0] = 1
+            jobContrasts = [(None, firstRegressor)]
+        tests = [sp.statops.glmContrast(betas, residualVariance, df,
+                                        useDesign, contrast)
+                 for name, contrast in jobContrasts]
+        print('Fitted %d maps of %d subjects in %.1f s'
+              % (len(jobList), len(useList), time.time() - startTime))
+
+        # Split the results back into the jobs
+        start = 0
+        for hemi, radius, maps in jobList:
+            surface, surfacePath, keepVerteces = templates[hemi]
+            numberVerteces = len(surface[0])
+            stop = start + len(keepVerteces)
+            outMaps = {'beta': betas[:, start:stop]}
+            outMaps['rvar'] = residualVariance[start:stop]
+            contrastBaseName = (glmContrastTemp % (radius, hemi))
+            for (name, contrast), test in zip(jobContrasts, tests):
+                if name is None:
+                    name = contrastBaseName
+                for key in ['t', 'F', 'sig']:
+                    if key in test:
+                        outMaps[os.path.join(name, key)] = test[key][start:
+                                                                     stop]
+                outMaps[os.path.join(name, 'gamma')] = test['gamma'][:, start:
+                                                                     stop]
+
+            modelDir = os.path.join(glmOutDir, contrastBaseName)
+            for outName, outVec in outMaps.items():
+                outPath = os.path.join(modelDir, '%s.mgh' % (outName))
+                vertVec = sp.procops.mapBack(outVec, keepVerteces,
+                                             numberVerteces)
+                # single frame maps are written as plain vectors
+                if vertVec.ndim > 1 and len(vertVec) == 1:
+                    vertVec = vertVec[0]
+                sp.fileops.saveMgh(outPath, vertVec)
+            start = stop
+
+
+def doLabelSummary():
+    '''
+    This method summarizes the label-wise surface computation outputs
+    across subjects. For every hemisphere, radius and parcel it computes the
+    mean, the standard deviation and a bootstrap confidence interval of the
+    mean and writes all of them to one table at labelSummaryPath.
+    '''
+    # Stuff to be supplied dynamically
+    radii = cf.radii
+    hemispheres = cf.hemipsheres
+
+    if not cf.doLabel:
+        message = ('The label summary needs the label outputs, set doLabel'
+                   ' and run the surface computation first')
+        raise Exception(message)
+
+    subjectList = loadSubjectList()
+
+    lines = ['# hemi radius parcel subjects mean sd lower upper']
+    for hemi in hemispheres:
+        parcelIds, parcelNames = sp.fileops.loadParcels(cf.annotTemp % (hemi))
+        numberParcels = len(parcelNames)
+        for radius in radii:
+            useList, maps = loadSubjectStack(subjectList, radius, hemi)
+            if not useList:
+                continue
+            # The label outputs hold the same value at every vertex of a
+            # parcel, so this gives the subjects x parcels matrix
+            parcelValues, counts = sp.procops.parcelMeans(maps, parcelIds,
+                                                          numberParcels)
+            summary = sp.statops.bootstrapSummary(parcelValues,
+                                                  cf.bootstrapConfidence,
+                                                  cf.bootstrapResamples,
+                                                  cf.bootstrapChunk,
+                                                  cf.bootstrapSeed)
+            for parcel in np.flatnonzero(counts):
+                lines.append('%s %d %s %d %.6f %.6f %.6f %.6f'
+                             % (hemi, radius, parcelNames[parcel],
+                                len(useList), summary['mean'][parcel],
+                                summary['sd'][parcel],
+                                summary['lower'][parcel],
+                                summary['upper'][parcel]))
+
+    table = '\n'.join(lines) + '\n'
+    outPath = sp.fileops.saveTxt(cf.labelSummaryPath, table)
+    print('Written label summary at %s' % (outPath))
+
+
+def exportCohort():
+    '''
+    Writes the maps in the cohort stores out as the mgh files of the
+    subjects, the same files the surface computation writes with
+    exportSubjectMaps set
+    '''
+    for hemi in cf.hemipsheres:
+        for suffix in ['', '_pval']:
+            quantity = storeQuantity(suffix)
+            store = sp.fileops.loadCohortStore(cf.cohortDir, hemi, quantity)
+            if store is None:
+                continue
+            numberMaps = 0
+            for row, subID in enumerate(store.subjects):
+                for column, radius in enumerate(store.radii):
+                    if not store.written[row, column]:
+                        continue
+                    saveOut = subjectOutPath(hemi, subID, radius,
+                                             suffix=suffix)
+                    sp.fileops.saveMgh('%s.mgh' % (saveOut),
+                                       store.data[:, row, column])
+                    numberMaps += 1
+            print('Exported %d maps of %s on %s' % (numberMaps, quantity,
+                                                   hemi))
+
+
 def convertFile():
     '''
     This method is supposed to convert any input file to any other file type
@@ -453,6 +1183,14 @@ if __name__ == '__main__':
                      + '    \'surface\' - do the surface computation\n'
                      + '    \'glm\' - run the glm on the surface'
                      + ' computation outputs\n'
+                     + '    \'group\' - test the surface computation'
+                     + ' outputs against 0 right here\n'
+                     + '    \'fitglm\' - fit the glm of the FSGD file to the'
+                     + ' surface computation outputs right here\n'
+                     + '    \'labelstats\' - summarize the label outputs'
+                     + ' across subjects\n'
+                     + '    \'export\' - write the cohort store out as mgh'
+                     + ' files of the subjects\n'
                      + 'Supply no argument to see this message.')
     if len(sys.argv) == 1:
         # Somebody just started the thing without supplying arguments
@@ -461,12 +1199,21 @@ if __name__ == '__main__':
         message = 'You supplied too many arguments, I can only handle one'
         raise Exception(message)
     else:
+        sp.fileops.setLoaderCacheSize(cf.loaderCacheSize)
         if sys.argv[1] == 'gradient':
             makeGradient()
         elif sys.argv[1] == 'surface':
             doSurfaceCorrelation()
         elif sys.argv[1] == 'glm':
             makeGlm()
+        elif sys.argv[1] == 'group':
+            doGroupTest()
+        elif sys.argv[1] == 'fitglm':
+            doGlm()
+        elif sys.argv[1] == 'labelstats':
+            doLabelSummary()
+        elif sys.argv[1] == 'export':
+            exportCohort()
         else:
             message = ('I did not understand the argument of %s' % (sys.argv[1])
                        + '\nI will print the helpfile now:\n\n')